@@ -1,22 +1,28 @@
-from collections.abc import AsyncGenerator
 from typing import Annotated
 
-from fastapi import Depends, HTTPException, Security, status
+from fastapi import Depends, HTTPException, Request, Security, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from app.config import get_settings
 from app.core.exceptions import AuthenticationError
+from app.core.idempotency import IdempotencyStore
+from app.core.rate_limit import RateLimiter
 from app.core.security import verify_token
 from app.models.domain.user import User
 from app.repositories.base import BaseRepository
+from app.repositories.ledger import LedgerFlusher, LedgerRepository
+from app.repositories.valuations import ValuationRepository
 from app.repositories.wallet import WalletRepository
 from app.services.auth import AuthService
+from app.services.coalescer import WriteCoalescer
 from app.services.exchange import ExchangeRateService
 from app.services.wallet import WalletService
+from app.services.wallet_events import WalletEventHub
 
 settings = get_settings()
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 
 async def get_current_user_id(
@@ -36,12 +42,49 @@ async def get_current_user_id(
         ) from e
 
 
-async def get_db_client() -> AsyncGenerator[AsyncIOMotorClient, None]:
-    client = AsyncIOMotorClient(settings.MONGODB_URL)
+async def get_current_admin(
+    credentials: HTTPAuthorizationCredentials = Security(security),
+) -> str:
     try:
-        yield client
-    finally:
-        client.close()
+        payload = verify_token(credentials.credentials)
+    except AuthenticationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        ) from e
+
+    email = payload.get("email")
+    if not email or email not in settings.ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return email
+
+
+def rate_limit(scope: str, per_ip: bool = False):
+    # routes that require a token are limited per user; per_ip is for the unauthenticated ones,
+    # where request.client is the forwarded client when the peer is in FORWARDED_ALLOW_IPS
+    async def check_rate_limit(
+        request: Request,
+        credentials: HTTPAuthorizationCredentials | None = Security(optional_security),
+    ) -> None:
+        identities = []
+        if per_ip:
+            if request.client is not None:
+                identities.append(f"ip:{request.client.host}")
+        elif credentials is not None:
+            try:
+                identities.append(f"user:{verify_token(credentials.credentials)['sub']}")
+            except (AuthenticationError, KeyError):
+                pass
+
+        limiter: RateLimiter = request.app.state.rate_limiter
+        await limiter.hit(scope, identities)
+
+    return check_rate_limit
+
+
+async def get_db_client(request: Request) -> AsyncIOMotorClient:
+    return request.app.state.mongo_client
 
 
 async def get_wallet_collection(client: AsyncIOMotorClient = Depends(get_db_client)):
@@ -56,16 +99,48 @@ async def get_user_repository(collection=Depends(get_user_collection)) -> BaseRe
     return BaseRepository[User](collection, User)
 
 
-async def get_wallet_repository(collection=Depends(get_wallet_collection)) -> WalletRepository:
-    return WalletRepository(collection)
+async def get_ledger_repository(
+    client: AsyncIOMotorClient = Depends(get_db_client),
+) -> LedgerRepository:
+    return LedgerRepository(
+        client.wallet_app.wallet_ledger,
+        client.wallet_app.wallet_snapshots,
+        settings.LEDGER_SNAPSHOT_INTERVAL,
+    )
 
 
-async def get_exchange_service() -> AsyncGenerator[ExchangeRateService, None]:
-    service = ExchangeRateService()
-    try:
-        yield service
-    finally:
-        await service.close()
+async def get_valuation_repository(
+    client: AsyncIOMotorClient = Depends(get_db_client),
+) -> ValuationRepository:
+    return ValuationRepository(client.wallet_app.wallet_valuations)
+
+
+async def get_ledger_flusher(request: Request) -> LedgerFlusher:
+    return request.app.state.ledger_flusher
+
+
+async def get_wallet_repository(
+    collection=Depends(get_wallet_collection),
+    ledger_repository: LedgerRepository = Depends(get_ledger_repository),
+    ledger_flusher: LedgerFlusher = Depends(get_ledger_flusher),
+) -> WalletRepository:
+    return WalletRepository(collection, ledger_repository, ledger_flusher)
+
+
+async def get_exchange_service(request: Request) -> ExchangeRateService:
+    return request.app.state.exchange_service
+
+
+async def get_idempotency_store(request: Request) -> IdempotencyStore:
+    return request.app.state.idempotency
+
+
+async def get_wallet_events(request: Request) -> WalletEventHub:
+    return request.app.state.wallet_events
+
+
+async def get_write_coalescer(request: Request) -> WriteCoalescer | None:
+    return request.app.state.write_coalescer
 
 
 async def get_auth_service(
@@ -77,8 +152,14 @@ async def get_auth_service(
 async def get_wallet_service(
     wallet_repository: WalletRepository = Depends(get_wallet_repository),
     exchange_service: ExchangeRateService = Depends(get_exchange_service),
+    valuation_repository: ValuationRepository = Depends(get_valuation_repository),
+    write_coalescer: WriteCoalescer | None = Depends(get_write_coalescer),
+    wallet_events: WalletEventHub = Depends(get_wallet_events),
 ) -> WalletService:
-    return WalletService(wallet_repository, exchange_service)
+    return WalletService(
+        wallet_repository, exchange_service, valuation_repository, write_coalescer, wallet_events
+    )
 
 
 CurrentUser = Annotated[str, Depends(get_current_user_id)]
+CurrentAdmin = Annotated[str, Depends(get_current_admin)]
@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+
+from app.api.deps import CurrentAdmin, get_exchange_service, get_wallet_service
+from app.services.exchange import ExchangeRateService
+from app.services.wallet import ExportFormat, WalletService
+
+router = APIRouter()
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+@router.get("/wallets/export", description="Stream PLN valuations of all wallets")
+async def export_wallets(
+    current_admin: CurrentAdmin,
+    export_format: ExportFormat = Query("ndjson", alias="format"),
+    wallet_service: WalletService = Depends(get_wallet_service),
+    exchange_service: ExchangeRateService = Depends(get_exchange_service),
+) -> StreamingResponse:
+    rates = await exchange_service.get_current_rates()
+    return StreamingResponse(
+        wallet_service.export_valuations(rates, export_format),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f"attachment; filename=wallets.{export_format}"},
+    )
@@ -0,0 +1,44 @@
+from decimal import Decimal
+
+from fastapi import APIRouter, Depends, Query
+
+from app.api.deps import CurrentUser, get_exchange_service, rate_limit
+from app.models.schemas.rates import ConversionBatchRequest, ConversionRequest, ConversionResponse
+from app.services.exchange import ExchangeRateService
+
+router = APIRouter()
+
+rates_limit = Depends(rate_limit("rates"))
+
+
+@router.get(
+    "/convert",
+    response_model=ConversionResponse,
+    description="Quote a conversion between any two table C currencies or PLN",
+    dependencies=[rates_limit],
+)
+async def convert(
+    current_user: CurrentUser,
+    from_currency: str = Query(alias="from", min_length=3, max_length=3),
+    to_currency: str = Query(alias="to", min_length=3, max_length=3),
+    amount: Decimal = Query(gt=0),
+    exchange_service: ExchangeRateService = Depends(get_exchange_service),
+) -> ConversionResponse:
+    conversion = ConversionRequest(
+        from_currency=from_currency, to_currency=to_currency, amount=amount
+    )
+    return await exchange_service.convert([conversion])
+
+
+@router.post(
+    "/convert/batch",
+    response_model=ConversionResponse,
+    description="Quote several conversions against the same rates table",
+    dependencies=[rates_limit],
+)
+async def convert_batch(
+    batch: ConversionBatchRequest,
+    current_user: CurrentUser,
+    exchange_service: ExchangeRateService = Depends(get_exchange_service),
+) -> ConversionResponse:
+    return await exchange_service.convert(batch.conversions)
@@ -1,41 +1,221 @@
-from fastapi import APIRouter, Depends
-from fastapi_cache import FastAPICache
-from fastapi_cache.decorator import cache
+from datetime import date
 
-from app.api.deps import CurrentUser, get_wallet_service
-from app.models.schemas.wallet import WalletOperation, WalletResponse
+from fastapi import APIRouter, Depends, Header, Query, Response, status
+from fastapi.responses import StreamingResponse
+
+from app.api.deps import (
+    CurrentUser,
+    get_idempotency_store,
+    get_wallet_events,
+    get_wallet_service,
+    rate_limit,
+)
+from app.core.cache import cache_wallet, get_cached_wallet, get_cached_wallet_etag
+from app.core.idempotency import IdempotencyStore
+from app.core.metrics import first_wallet_response
+from app.core.responses import (
+    RawJSONResponse,
+    conditional_json_response,
+    encode_model,
+    etag_matches,
+    not_modified_response,
+)
+from app.models.domain.wallet import Wallet
+from app.models.schemas.wallet import (
+    TransactionPage,
+    ValuationHistory,
+    WalletBatchRequest,
+    WalletOperation,
+    WalletResponse,
+)
 from app.services.wallet import WalletService
+from app.services.wallet_events import WalletEventHub
 
 router = APIRouter()
 
+read_limit = Depends(rate_limit("wallet_read"))
+write_limit = Depends(rate_limit("wallet_write"))
+IdempotencyKey = Header(
+    None,
+    max_length=255,
+    description="Retries carrying the same key return the first response instead of "
+    "applying the change again",
+)
+
 
 @router.get(
-    "", response_model=WalletResponse, description="Get current wallet status with PLN values"
+    "",
+    response_model=WalletResponse,
+    description="Get current wallet status with PLN values. Send the ETag back in "
+    "If-None-Match to get 304 Not Modified while nothing changed.",
+    dependencies=[read_limit],
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "Wallet unchanged"}},
 )
-@cache(expire=60, key_builder=lambda *args, **kwargs: f"wallet:{kwargs['kwargs']['current_user']}")
 async def get_wallet(
-    current_user: CurrentUser, wallet_service: WalletService = Depends(get_wallet_service)
-) -> WalletResponse:
-    return await wallet_service.get_wallet(current_user)
+    current_user: CurrentUser,
+    as_of: date | None = Query(
+        None, description="Value current balances with the rates table effective on this date"
+    ),
+    if_none_match: str | None = Header(None),
+    wallet_service: WalletService = Depends(get_wallet_service),
+) -> Response:
+    if as_of is not None:
+        return RawJSONResponse(
+            encode_model(await wallet_service.get_wallet_as_of(current_user, as_of))
+        )
+
+    # pollers that are up to date are answered from the ETag alone
+    rates_table = wallet_service.rates_table
+    if if_none_match and (etag := await get_cached_wallet_etag(current_user, rates_table)):
+        if etag_matches(if_none_match, etag):
+            first_wallet_response.record()
+            return not_modified_response(etag)
+
+    if cached := await get_cached_wallet(current_user, rates_table):
+        etag, body = cached
+    else:
+        response = await wallet_service.get_wallet(current_user)
+        etag, body = response.etag, encode_model(response)
+        # named after the table the body was valued with, which a refresh may have just replaced
+        await cache_wallet(current_user, wallet_service.rates_table, body, etag, response.version)
+    first_wallet_response.record()
+    return conditional_json_response(body, etag, if_none_match)
+
+
+@router.get(
+    "/stream",
+    description="Server-sent events: the wallet valuation now, then again whenever the "
+    "balances change or a new rates table is loaded",
+    dependencies=[read_limit],
+    response_class=StreamingResponse,
+)
+async def stream_wallet(
+    current_user: CurrentUser,
+    wallet_service: WalletService = Depends(get_wallet_service),
+    wallet_events: WalletEventHub = Depends(get_wallet_events),
+) -> StreamingResponse:
+    wallet: Wallet | None = None
+
+    async def load(reload: bool) -> tuple[str, bytes]:
+        # a new rates table wakes every stream, and only needs the balances valued again
+        nonlocal wallet
+        if reload or wallet is None:
+            wallet = await wallet_service.load_wallet(current_user)
+        response = await wallet_service.value_wallet(wallet)
+        return response.etag, encode_model(response)
+
+    return StreamingResponse(
+        wallet_events.stream(current_user, load),
+        media_type="text/event-stream",
+        # X-Accel-Buffering stops nginx from holding events back
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/transactions",
+    response_model=TransactionPage,
+    description="Page through wallet operations, newest first",
+    dependencies=[read_limit],
+)
+async def list_transactions(
+    current_user: CurrentUser,
+    limit: int = Query(50, ge=1, le=200),
+    before: int | None = Query(None, ge=1, description="next_before from the previous page"),
+    wallet_service: WalletService = Depends(get_wallet_service),
+) -> TransactionPage:
+    return await wallet_service.list_transactions(current_user, limit, before)
+
+
+@router.get(
+    "/history",
+    response_model=ValuationHistory,
+    description="Daily PLN valuation series. Points are stored only on days the valuation "
+    "changed; each one holds until the next.",
+    dependencies=[read_limit],
+)
+async def get_valuation_history(
+    current_user: CurrentUser,
+    start: date = Query(alias="from"),
+    end: date = Query(alias="to"),
+    wallet_service: WalletService = Depends(get_wallet_service),
+) -> ValuationHistory:
+    return await wallet_service.get_valuation_history(current_user, start, end)
 
 
-@router.post("/add", response_model=WalletResponse, description="Add funds to wallet")
+@router.post(
+    "/add",
+    response_model=WalletResponse,
+    description="Add funds to wallet",
+    dependencies=[write_limit],
+)
 async def add_funds(
     operation: WalletOperation,
     current_user: CurrentUser,
+    idempotency_key: str | None = IdempotencyKey,
     wallet_service: WalletService = Depends(get_wallet_service),
-) -> WalletResponse:
-    result = await wallet_service.add_funds(current_user, operation)
-    await FastAPICache.get_backend().clear(key=f"wallet:{current_user}")
-    return result
+    idempotency: IdempotencyStore = Depends(get_idempotency_store),
+) -> RawJSONResponse:
+    async def execute() -> bytes:
+        response = await wallet_service.add_funds(current_user, operation)
+        body = encode_model(response)
+        await cache_wallet(
+            current_user, wallet_service.rates_table, body, response.etag, response.version
+        )
+        return body
+
+    return await idempotency.run(
+        current_user, idempotency_key, f"add:{operation.model_dump_json()}", execute
+    )
 
 
-@router.post("/subtract", response_model=WalletResponse, description="Subtract funds from wallet")
+@router.post(
+    "/subtract",
+    response_model=WalletResponse,
+    description="Subtract funds from wallet",
+    dependencies=[write_limit],
+)
 async def subtract_funds(
     operation: WalletOperation,
     current_user: CurrentUser,
+    idempotency_key: str | None = IdempotencyKey,
+    wallet_service: WalletService = Depends(get_wallet_service),
+    idempotency: IdempotencyStore = Depends(get_idempotency_store),
+) -> RawJSONResponse:
+    async def execute() -> bytes:
+        response = await wallet_service.subtract_funds(current_user, operation)
+        body = encode_model(response)
+        await cache_wallet(
+            current_user, wallet_service.rates_table, body, response.etag, response.version
+        )
+        return body
+
+    return await idempotency.run(
+        current_user, idempotency_key, f"subtract:{operation.model_dump_json()}", execute
+    )
+
+
+@router.post(
+    "/batch",
+    response_model=WalletResponse,
+    description="Apply several operations atomically",
+    dependencies=[write_limit],
+)
+async def apply_batch(
+    batch: WalletBatchRequest,
+    current_user: CurrentUser,
+    idempotency_key: str | None = IdempotencyKey,
     wallet_service: WalletService = Depends(get_wallet_service),
-) -> WalletResponse:
-    result = await wallet_service.subtract_funds(current_user, operation)
-    await FastAPICache.get_backend().clear(key=f"wallet:{current_user}")
-    return result
+    idempotency: IdempotencyStore = Depends(get_idempotency_store),
+) -> RawJSONResponse:
+    async def execute() -> bytes:
+        response = await wallet_service.apply_batch(current_user, batch.operations)
+        body = encode_model(response)
+        await cache_wallet(
+            current_user, wallet_service.rates_table, body, response.etag, response.version
+        )
+        return body
+
+    return await idempotency.run(
+        current_user, idempotency_key, f"batch:{batch.model_dump_json()}", execute
+    )
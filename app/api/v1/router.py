@@ -1,9 +1,13 @@
 from fastapi import APIRouter
 
-from app.api.v1.endpoints import auth, wallet
+from app.api.v1.endpoints import admin, auth, rates, wallet
 
 api_router = APIRouter()
 
 api_router.include_router(auth.router, prefix="/auth", tags=["auth"])
 
 api_router.include_router(wallet.router, prefix="/wallet", tags=["wallet"])
+
+api_router.include_router(rates.router, prefix="/rates", tags=["rates"])
+
+api_router.include_router(admin.router, prefix="/admin", tags=["admin"])
@@ -0,0 +1,69 @@
+"""Maintain the wallet ledger.
+
+Moves ledger entries left in a wallet's pending_entries (e.g. after a crash between the balance
+update and the ledger insert) into the ledger collection, and snapshots every wallet that is
+LEDGER_SNAPSHOT_INTERVAL or more entries past its latest snapshot, so rebuilding a balance never
+replays more than one interval.
+
+Usage: python -m app.commands.compact_ledger [--batch-size N]
+"""
+
+import argparse
+import asyncio
+import logging
+
+from app.config import get_settings
+from app.core.database import PoolStatsListener, create_mongo_client
+from app.models.utils import to_minor_units
+from app.repositories.ledger import LedgerRepository
+from app.repositories.wallet import WalletRepository, document_to_wallet
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+async def compact_ledger(wallet_repository: WalletRepository, batch_size: int) -> dict[str, int]:
+    ledger = wallet_repository.ledger
+    assert ledger is not None
+    stats = {"flushed": 0, "snapshots": 0}
+    latest_snapshots = await ledger.latest_snapshot_seqs()
+
+    cursor = wallet_repository.collection.find({"seq": {"$gt": 0}}).batch_size(batch_size)
+    async for document in cursor:
+        wallet = document_to_wallet(document)
+        if document.get("pending_entries"):
+            await wallet_repository.flush_ledger(document, wallet)
+            stats["flushed"] += 1
+
+        latest = latest_snapshots.get(wallet.user_id, 0)
+        if document["seq"] - latest >= ledger.snapshot_interval:
+            balances = {
+                currency: to_minor_units(amount) for currency, amount in wallet.balances.items()
+            }
+            await ledger.save_snapshot(wallet.user_id, document["seq"], balances)
+            stats["snapshots"] += 1
+
+    return stats
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    client = create_mongo_client(settings, PoolStatsListener())
+    try:
+        db = client.wallet_app
+        ledger = LedgerRepository(
+            db.wallet_ledger, db.wallet_snapshots, settings.LEDGER_SNAPSHOT_INTERVAL
+        )
+        await ledger.ensure_indexes()
+        stats = await compact_ledger(WalletRepository(db.wallets, ledger), args.batch_size)
+        logger.info("Done: %s", stats)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
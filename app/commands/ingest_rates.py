@@ -0,0 +1,64 @@
+"""Fill the local exchange-rate history with NBP table C.
+
+Without arguments the command ingests every table published since the latest stored one, which
+is what the daily job runs. Pass --from to backfill an older range.
+
+Usage: python -m app.commands.ingest_rates [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+"""
+
+import argparse
+import asyncio
+import logging
+from datetime import date, timedelta
+
+from app.config import get_settings
+from app.core.database import PoolStatsListener, create_mongo_client
+from app.repositories.rates import RateHistoryRepository
+from app.services.exchange import ExchangeRateService
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+NBP_MAX_RANGE_DAYS = 93
+
+
+async def ingest_rates(
+    exchange_service: ExchangeRateService, history: RateHistoryRepository, start: date, end: date
+) -> int:
+    stored = 0
+    window_start = start
+    while window_start <= end:
+        window_end = min(window_start + timedelta(days=NBP_MAX_RANGE_DAYS - 1), end)
+        for snapshot in await exchange_service.fetch_tables(window_start, window_end):
+            await history.save_table(snapshot)
+            stored += 1
+        logger.info("Ingested tables %s..%s", window_start, window_end)
+        window_start = window_end + timedelta(days=1)
+    return stored
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from", dest="start", type=date.fromisoformat)
+    parser.add_argument("--to", dest="end", type=date.fromisoformat, default=date.today())
+    args = parser.parse_args()
+
+    client = create_mongo_client(settings, PoolStatsListener())
+    history = RateHistoryRepository(client.wallet_app.exchange_rate_tables)
+    exchange_service = ExchangeRateService(history=history)
+    try:
+        await history.ensure_indexes()
+        start = args.start
+        if start is None:
+            latest = await history.latest_effective_date()
+            start = latest + timedelta(days=1) if latest else args.end
+        stored = await ingest_rates(exchange_service, history, start, args.end)
+        logger.info("Done, %d tables stored", stored)
+    finally:
+        await exchange_service.close()
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+"""Convert legacy float wallet balances to int64 minor units.
+
+The migration runs online: every wallet is converted with a compare-and-set update and
+progress is checkpointed after each batch, so an interrupted run resumes where it stopped.
+
+Usage: python -m app.commands.migrate_balances [--batch-size N] [--restart]
+"""
+
+import argparse
+import asyncio
+import logging
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from app.config import get_settings
+from app.core.database import PoolStatsListener, create_mongo_client
+from app.models.utils import get_current_time
+from app.repositories.wallet import WalletRepository
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+MIGRATION_ID = "wallet_balances_minor_units"
+
+
+async def migrate_balances(
+    wallets: AsyncIOMotorCollection, migrations: AsyncIOMotorCollection, batch_size: int
+) -> int:
+    repository = WalletRepository(wallets)
+    checkpoint = await migrations.find_one({"_id": MIGRATION_ID})
+    last_id = checkpoint["last_id"] if checkpoint else None
+    migrated = 0
+
+    while True:
+        query: dict = {"balances": {"$exists": True}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        documents = (
+            await wallets.find(query, {"balances": 1})
+            .sort("_id", 1)
+            .limit(batch_size)
+            .to_list(length=batch_size)
+        )
+        if not documents:
+            break
+
+        for document in documents:
+            if await repository.migrate_legacy_balances(document):
+                migrated += 1
+
+        last_id = documents[-1]["_id"]
+        await migrations.update_one(
+            {"_id": MIGRATION_ID},
+            {"$set": {"last_id": last_id, "updated_at": get_current_time()}},
+            upsert=True,
+        )
+        logger.info("Migrated %d wallets (checkpoint %s)", migrated, last_id)
+
+    return migrated
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--restart", action="store_true", help="ignore the stored checkpoint")
+    args = parser.parse_args()
+
+    client = create_mongo_client(settings, PoolStatsListener())
+    try:
+        db = client.wallet_app
+        if args.restart:
+            await db.migrations.delete_one({"_id": MIGRATION_ID})
+        migrated = await migrate_balances(db.wallets, db.migrations, args.batch_size)
+        logger.info("Done, %d wallets migrated", migrated)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
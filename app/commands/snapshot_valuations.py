@@ -0,0 +1,115 @@
+"""Store the daily PLN valuation of every wallet that changed.
+
+A wallet gets a point for the day only if its updated_at is newer than the previous run or the
+rate of one of its currencies moved since then. With --date, a past day is backfilled: every
+wallet gets a point, and the state of the daily run is left alone. Rates come from the local
+history store, so run app.commands.ingest_rates first.
+
+Usage: python -m app.commands.snapshot_valuations [--date YYYY-MM-DD]
+"""
+
+import argparse
+import asyncio
+import logging
+from datetime import date
+from decimal import Decimal
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from app.config import get_settings
+from app.core.database import PoolStatsListener, create_mongo_client
+from app.models.utils import ensure_utc, get_current_time, to_minor_units
+from app.repositories.rates import RateHistoryRepository
+from app.repositories.valuations import ValuationRepository
+from app.repositories.wallet import WalletRepository
+from app.services.exchange import ExchangeRateService
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+JOB_ID = "valuation_snapshots"
+
+
+async def snapshot_valuations(  # noqa: PLR0913
+    wallet_repository: WalletRepository,
+    valuations: ValuationRepository,
+    jobs: AsyncIOMotorCollection,
+    rates: dict[str, Decimal],
+    day: date,
+    incremental: bool = True,
+) -> int:
+    # the job state describes the last daily run, so a backfill neither reads nor updates it
+    state = await jobs.find_one({"_id": JOB_ID}) if incremental else None
+    since = ensure_utc(state["last_run_at"]) if state else None
+    previous = {code: Decimal(rate) for code, rate in state["rates"].items()} if state else {}
+    moved = {
+        code for code in rates.keys() | previous.keys() if rates.get(code) != previous.get(code)
+    }
+    started_at = get_current_time()
+    written = 0
+
+    async for wallets in wallet_repository.iter_wallets(settings.EXPORT_BATCH_SIZE):
+        documents = []
+        for wallet in wallets:
+            unchanged = since is not None and ensure_utc(wallet.updated_at) <= since
+            if unchanged and not moved & wallet.balances.keys():
+                continue
+
+            pln_values = ExchangeRateService.value_balances(wallet.balances, rates)
+            documents.append(
+                {
+                    "user_id": wallet.user_id,
+                    "balances": {c: to_minor_units(a) for c, a in wallet.balances.items()},
+                    "pln_values": {c: to_minor_units(v) for c, v in pln_values.items()},
+                    "total_pln": to_minor_units(sum(pln_values.values(), Decimal("0"))),
+                }
+            )
+        await valuations.save_many(day, documents)
+        written += len(documents)
+
+    if not incremental:
+        return written
+    await jobs.update_one(
+        {"_id": JOB_ID},
+        {
+            "$set": {
+                "last_run_at": started_at,
+                "rates": {code: str(rate) for code, rate in rates.items()},
+            }
+        },
+        upsert=True,
+    )
+    return written
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", dest="day", type=date.fromisoformat, default=None)
+    args = parser.parse_args()
+    day = args.day or date.today()
+
+    client = create_mongo_client(settings, PoolStatsListener())
+    try:
+        db = client.wallet_app
+        snapshot = await RateHistoryRepository(db.exchange_rate_tables).get_as_of(day)
+        if snapshot is None:
+            raise SystemExit(f"No rates table stored on or before {day}")
+
+        valuations = ValuationRepository(db.wallet_valuations)
+        await valuations.ensure_indexes()
+        written = await snapshot_valuations(
+            WalletRepository(db.wallets),
+            valuations,
+            db.jobs,
+            snapshot.rates,
+            day,
+            incremental=args.day is None,
+        )
+        logger.info("Stored %d valuation points for %s", written, day)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -15,24 +15,95 @@ class Settings(BaseSettings):
 
     # Database settings
     MONGODB_URL: str = "mongodb://localhost:27017"
+    MONGODB_MAX_POOL_SIZE: int = 100
+    MONGODB_MIN_POOL_SIZE: int = 0
+    MONGODB_MAX_IDLE_TIME_MS: int = 60000
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS: int = 5000
+    MONGODB_CONNECT_TIMEOUT_MS: int = 5000
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS: int = 5000
+    MONGODB_TIMEOUT_MS: int = 10000  # per-operation timeout
+
+    LEDGER_SNAPSHOT_INTERVAL: int = 100  # ledger entries between balance snapshots
+    LEDGER_FLUSH_WORKERS: int = 4
+    LEDGER_FLUSH_MAX_QUEUE: int = 1000  # beyond this, requests flush their own ledger entries
+
+    # Write coalescing: same-user wallet writes within the window become one update
+    WRITE_COALESCING_ENABLED: bool = False
+    WRITE_COALESCING_WINDOW_MS: int = 5
+    WRITE_COALESCING_MAX_BATCH: int = 50
 
     # JWT settings
     JWT_SECRET_KEY: str = "your-secret-key-here"  # Change in production!
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    TOKEN_CACHE_MAXSIZE: int = 10000  # verified tokens kept in memory, 0 disables the cache
+
+    # Password hashing settings
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_QUEUE: int = 32  # requests beyond workers + queue are shed with 503
 
     # NBP API settings
     NBP_API_BASE_URL: str = "https://api.nbp.pl/api"
     EXCHANGE_RATES_CACHE_TTL: int = 1800  # 30 minutes
+    EXCHANGE_RATES_REFRESH_AHEAD: int = 300  # refresh this long before the TTL runs out
+    EXCHANGE_RATES_STALE_TTL: int = 600  # serve expired rates this long while revalidating
+    EXCHANGE_RATES_RETRY_INTERVAL: int = 30
+    EXCHANGE_RATES_WARM_TIMEOUT: float = 2.0  # startup wait for a snapshot from Redis or Mongo
+    NBP_HTTP2: bool = False
+    NBP_CONNECT_TIMEOUT: float = 3.0
+    NBP_READ_TIMEOUT: float = 5.0
+    NBP_MAX_CONNECTIONS: int = 10
+    NBP_MAX_KEEPALIVE_CONNECTIONS: int = 5
+    NBP_KEEPALIVE_EXPIRY: float = 30.0
+    NBP_MAX_RETRIES: int = 2
+    NBP_RETRY_BACKOFF: float = 0.2  # seconds, doubled on every retry
+    NBP_CIRCUIT_FAILURE_THRESHOLD: int = 3  # consecutive failed fetches that open the circuit
+    NBP_CIRCUIT_RESET_TIMEOUT: float = 30.0  # seconds before a trial request is let through
 
     # Redis settings
     REDIS_URL: str = "redis://localhost:6379"
 
+    # Rate limiting: token buckets per user, or per client IP on auth routes,
+    # as "<requests>/<second|minute|hour|day>"
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_AUTH: str = "10/minute"
+    RATE_LIMIT_WALLET_READ: str = "120/minute"
+    RATE_LIMIT_WALLET_WRITE: str = "30/minute"
+    RATE_LIMIT_RATES: str = "300/minute"
+
+    # Idempotency-Key handling for wallet mutations
+    IDEMPOTENCY_TTL: int = 86400  # how long a stored response is replayed
+    IDEMPOTENCY_LOCK_TIMEOUT: float = 10.0  # how long duplicates wait for the first request
+    IDEMPOTENCY_POLL_INTERVAL: float = 0.05
+
+    # Cross-worker invalidation of in-process caches
+    INVALIDATION_RECONNECT_DELAY: float = 1.0
+
+    # GET /wallet/stream
+    WALLET_EVENTS_KEEPALIVE: float = 15.0  # seconds between keepalive comments on idle streams
+    WALLET_EVENTS_RECONNECT_DELAY: float = 1.0
+    # a new rates table wakes every stream at a random point within this many seconds
+    WALLET_EVENTS_NOTIFY_SPREAD: float = 2.0
+
+    # Admin settings
+    ADMIN_EMAILS: list[str] = []
+    EXPORT_BATCH_SIZE: int = 500
+
+    # Metrics settings
+    METRICS_ENABLED: bool = True  # per-route request histograms; /metrics is always served
+
     # CORS settings
     CORS_ORIGINS: list[str] = ["*"]
 
-    # Server settings
-    WEB_CONCURRENCY: int = 4
+    # Server settings (app.server)
+    HOST: str = "0.0.0.0"
+    PORT: int = 8000
+    WEB_CONCURRENCY: int = 4  # worker processes
+    WORKER_TIMEOUT: int = 60  # a worker silent for this long is restarted
+    GRACEFUL_TIMEOUT: int = 30  # time for in-flight requests on shutdown or reload
+    KEEPALIVE_TIMEOUT: int = 5
+    # proxies whose X-Forwarded-For and X-Forwarded-Proto are trusted, comma-separated or "*"
+    FORWARDED_ALLOW_IPS: str = "127.0.0.1"
 
 
 @lru_cache
@@ -0,0 +1,86 @@
+import logging
+
+from fastapi_cache import FastAPICache
+from redis.commands.core import AsyncScript
+
+from app.core.metrics import record_cache_lookup
+
+logger = logging.getLogger(__name__)
+
+WALLET_CACHE_EXPIRE = 60
+
+# Responses of concurrent requests can reach the cache in any order, so the cached body carries
+# the version of the wallet document it values and is never replaced by an older one.
+WRITE_WALLET_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    local cached = tonumber(string.match(current, '^(%d+) '))
+    if cached and cached > tonumber(ARGV[1]) then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[4])
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[4])
+return 1
+"""
+# built once from bytes, so no client is needed to hash it; the client is passed on every call
+_write_wallet = AsyncScript(None, WRITE_WALLET_SCRIPT.encode())
+
+
+# Both keys name the rates table the body was valued with (see ExchangeRateService.rates_table), so
+# once a worker loads a new table it stops reading bodies and ETags made with the previous one;
+# those expire on their own.
+def wallet_cache_key(user_id: str, rates_table: str) -> str:
+    return f"wallet:{user_id}:{rates_table}"
+
+
+def wallet_etag_key(user_id: str, rates_table: str) -> str:
+    return f"wallet_etag:{user_id}:{rates_table}"
+
+
+async def get_cached_wallet(user_id: str, rates_table: str) -> tuple[str, bytes] | None:
+    try:
+        cached = await FastAPICache.get_backend().get(wallet_cache_key(user_id, rates_table))
+    except Exception:
+        logger.warning("Error reading wallet %s from cache", user_id, exc_info=True)
+        return None
+    record_cache_lookup("wallet", cached is not None)
+    if cached is None:
+        return None
+    header, _, body = cached.partition(b"\n")
+    return header.rpartition(b" ")[2].decode(), body
+
+
+async def get_cached_wallet_etag(user_id: str, rates_table: str) -> str | None:
+    # a few bytes, enough to answer If-None-Match without reading the body
+    try:
+        etag = await FastAPICache.get_backend().get(wallet_etag_key(user_id, rates_table))
+    except Exception:
+        logger.warning("Error reading wallet %s ETag from cache", user_id, exc_info=True)
+        return None
+    record_cache_lookup("wallet_etag", etag is not None)
+    return etag.decode() if etag is not None else None
+
+
+async def cache_wallet(
+    user_id: str, rates_table: str, body: bytes, etag: str, version: int | None
+) -> None:
+    # the encoded response body is cached, so a hit is sent back without decoding it; the version
+    # and ETag go in front of it and the ETag, for conditional requests, under its own key
+    if version is None:
+        # a coalesced request's own result; the last request of its batch caches the document
+        return
+    redis = FastAPICache.get_backend().redis
+    try:
+        await _write_wallet(
+            keys=[wallet_cache_key(user_id, rates_table), wallet_etag_key(user_id, rates_table)],
+            args=[
+                version,
+                b"%d %s\n%s" % (version, etag.encode(), body),
+                etag,
+                WALLET_CACHE_EXPIRE,
+            ],
+            client=redis,
+        )
+    except Exception:
+        logger.warning("Error writing wallet %s to cache", user_id, exc_info=True)
@@ -0,0 +1,61 @@
+import time
+from types import TracebackType
+from typing import Literal
+
+CircuitState = Literal["closed", "open", "half_open"]
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Wraps calls to an unreliable upstream. After failure_threshold consecutive failures the circuit
+# opens and calls fail immediately instead of waiting for the upstream to time out. Once
+# reset_timeout has passed, a single trial call is let through: success closes the circuit,
+# failure opens it for another reset_timeout.
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at: float | None = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> CircuitState:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def stats(self) -> dict[str, int | str]:
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+    def __enter__(self) -> None:
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError()
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        trial = self._trial_in_flight
+        self._trial_in_flight = False
+        if exc_type is None:
+            self.failures = 0
+            self._opened_at = None
+        elif issubclass(exc_type, Exception):
+            self.failures += 1
+            if trial or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+        # a cancelled call says nothing about the upstream, the next one becomes the trial
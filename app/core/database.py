@@ -0,0 +1,95 @@
+from threading import Lock
+from typing import Any
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+from app.config import Settings
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = Lock()
+        self.connections_open = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self.pool_clears = 0
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "connections_open": self.connections_open,
+                "checked_out": self.checked_out,
+                "waiting": self.waiting,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checkout_wait_avg_ms": (
+                    self.checkout_wait_total / self.checkouts * 1000 if self.checkouts else 0.0
+                ),
+                "checkout_wait_max_ms": self.checkout_wait_max * 1000,
+                "pool_clears": self.pool_clears,
+            }
+
+    def connection_check_out_started(self, event: monitoring.ConnectionCheckOutStartedEvent):
+        with self._lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent):
+        duration = getattr(event, "duration", None) or 0.0
+        with self._lock:
+            self.waiting -= 1
+            self.checked_out += 1
+            self.checkouts += 1
+            self.checkout_wait_total += duration
+            self.checkout_wait_max = max(self.checkout_wait_max, duration)
+
+    def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent):
+        with self._lock:
+            self.waiting -= 1
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent):
+        with self._lock:
+            self.connections_open += 1
+
+    def connection_closed(self, event: monitoring.ConnectionClosedEvent):
+        with self._lock:
+            self.connections_open -= 1
+
+    def connection_ready(self, event: monitoring.ConnectionReadyEvent):
+        pass
+
+    def pool_created(self, event: monitoring.PoolCreatedEvent):
+        pass
+
+    def pool_ready(self, event: monitoring.PoolReadyEvent):
+        pass
+
+    def pool_cleared(self, event: monitoring.PoolClearedEvent):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event: monitoring.PoolClosedEvent):
+        pass
+
+
+def create_mongo_client(settings: Settings, listener: PoolStatsListener) -> AsyncIOMotorClient:
+    return AsyncIOMotorClient(
+        settings.MONGODB_URL,
+        maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+        minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
+        maxIdleTimeMS=settings.MONGODB_MAX_IDLE_TIME_MS,
+        waitQueueTimeoutMS=settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        connectTimeoutMS=settings.MONGODB_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=settings.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        timeoutMS=settings.MONGODB_TIMEOUT_MS,
+        event_listeners=[listener],
+    )
@@ -38,6 +38,54 @@ class ExchangeRateError(WalletException):
         )
 
 
+class RatesNotAvailableError(WalletException):
+    def __init__(self, as_of: str):
+        super().__init__(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No exchange rates available as of {as_of}",
+            code="RATES_NOT_AVAILABLE",
+        )
+
+
+class ServiceOverloadedError(WalletException):
+    def __init__(self, retry_after: int = 1):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Service is overloaded, please retry later",
+            code="SERVICE_OVERLOADED",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class RateLimitExceededError(WalletException):
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, please retry later",
+            code="RATE_LIMITED",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class IdempotencyKeyReusedError(WalletException):
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was already used for a different request",
+            code="IDEMPOTENCY_KEY_REUSED",
+        )
+
+
+class IdempotencyInProgressError(WalletException):
+    def __init__(self, retry_after: int = 1):
+        super().__init__(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A request with this Idempotency-Key is still being processed",
+            code="IDEMPOTENCY_IN_PROGRESS",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
 class AuthenticationError(WalletException):
     def __init__(self):
         super().__init__(
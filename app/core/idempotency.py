@@ -0,0 +1,183 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+
+import orjson
+from fastapi import status
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.core.exceptions import (
+    IdempotencyInProgressError,
+    IdempotencyKeyReusedError,
+    WalletException,
+)
+from app.core.metrics import record_cache_lookup
+from app.core.responses import RawJSONResponse
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_PREFIX = "idempotency"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+# Every write made on behalf of a request checks that the key still holds that request's own
+# pending marker: a request that lost its marker must not overwrite whoever holds the key now.
+# An empty value deletes the key.
+REPLACE_IF_OWNED_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3])
+end
+return 1
+"""
+
+
+def _fingerprint(request: str) -> str:
+    return hashlib.blake2b(request.encode(), digest_size=16).hexdigest()
+
+
+def _record(fingerprint: str, status_code: int, body: bytes) -> bytes:
+    return orjson.dumps({"fingerprint": fingerprint, "status": status_code, "body": body.decode()})
+
+
+class IdempotencyStore:
+    def __init__(self, redis: Redis, ttl: int, lock_timeout: float, poll_interval: float):
+        self.redis = redis
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self._inflight: dict[str, asyncio.Event] = {}
+        self._replace_if_owned = redis.register_script(REPLACE_IF_OWNED_SCRIPT)
+
+    async def run(
+        self,
+        user_id: str,
+        idempotency_key: str | None,
+        request: str,
+        execute: Callable[[], Awaitable[bytes]],
+    ) -> RawJSONResponse:
+        if idempotency_key is None:
+            return RawJSONResponse(await execute())
+
+        key = f"{IDEMPOTENCY_PREFIX}:{user_id}:{idempotency_key}"
+        fingerprint = _fingerprint(request)
+        pending = orjson.dumps(
+            {"fingerprint": fingerprint, "status": None, "owner": uuid.uuid4().hex}
+        )
+        deadline = time.monotonic() + self.lock_timeout
+
+        while True:
+            try:
+                # the pending marker is kept alive while the request runs and expires on its
+                # own if the worker holding it dies
+                acquired = await self.redis.set(key, pending, nx=True, px=self._lock_ms)
+                raw = None if acquired else await self.redis.get(key)
+            except RedisError:
+                logger.warning("Idempotency store unavailable, executing without it", exc_info=True)
+                return RawJSONResponse(await execute())
+
+            if acquired:
+                record_cache_lookup(IDEMPOTENCY_PREFIX, False)
+                return await self._execute(key, fingerprint, pending, execute)
+            if raw is None:
+                continue
+
+            record = orjson.loads(raw)
+            if record["fingerprint"] != fingerprint:
+                raise IdempotencyKeyReusedError()
+            if record["status"] is not None:
+                record_cache_lookup(IDEMPOTENCY_PREFIX, True)
+                return RawJSONResponse(
+                    record["body"].encode(),
+                    status_code=record["status"],
+                    headers={REPLAYED_HEADER: "true"},
+                )
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise IdempotencyInProgressError()
+            await self._wait_for_first(key, remaining)
+
+    async def _wait_for_first(self, key: str, timeout: float) -> None:
+        # a duplicate handled by this worker is woken up as soon as the first one finishes;
+        # duplicates that landed on other workers poll
+        event = self._inflight.get(key)
+        if event is None:
+            await asyncio.sleep(min(self.poll_interval, timeout))
+            return
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(event.wait(), timeout)
+
+    @property
+    def _lock_ms(self) -> int:
+        return int(self.lock_timeout * 1000)
+
+    async def _execute(
+        self,
+        key: str,
+        fingerprint: str,
+        pending: bytes,
+        execute: Callable[[], Awaitable[bytes]],
+    ) -> RawJSONResponse:
+        event = self._inflight[key] = asyncio.Event()
+        keep_alive = asyncio.create_task(self._keep_alive(key, pending))
+        try:
+            try:
+                body = await execute()
+            finally:
+                keep_alive.cancel()
+        except WalletException as e:
+            # client errors are part of the outcome and replay as such; server errors may
+            # succeed on retry, so they release the key
+            if e.status_code < status.HTTP_500_INTERNAL_SERVER_ERROR:
+                body = orjson.dumps({"code": e.code, "message": e.detail})
+                await self._store(key, pending, _record(fingerprint, e.status_code, body))
+            else:
+                await self._release(key, pending)
+            raise
+        except BaseException:
+            await self._release(key, pending)
+            raise
+        else:
+            await self._store(key, pending, _record(fingerprint, status.HTTP_200_OK, body))
+            return RawJSONResponse(body)
+        finally:
+            if self._inflight.get(key) is event:
+                del self._inflight[key]
+            event.set()
+
+    async def _keep_alive(self, key: str, pending: bytes) -> None:
+        while True:
+            await asyncio.sleep(self.lock_timeout / 3)
+            try:
+                if not await self._replace_if_owned(
+                    keys=[key], args=[pending, pending, self._lock_ms]
+                ):
+                    logger.warning("Lost the idempotency marker for %s", key)
+                    return
+            except RedisError:
+                logger.warning("Error extending idempotency marker %s", key, exc_info=True)
+
+    async def _store(self, key: str, pending: bytes, record: bytes) -> None:
+        try:
+            stored = await self._replace_if_owned(
+                keys=[key], args=[pending, record, self.ttl * 1000]
+            )
+        except RedisError:
+            logger.warning("Error storing idempotent response %s", key, exc_info=True)
+            return
+        if not stored:
+            logger.warning("Idempotency key %s changed hands, response not stored", key)
+
+    async def _release(self, key: str, pending: bytes) -> None:
+        try:
+            await self._replace_if_owned(keys=[key], args=[pending, b"", 0])
+        except RedisError:
+            logger.warning("Error releasing idempotency key %s", key, exc_info=True)
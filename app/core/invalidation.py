@@ -0,0 +1,125 @@
+import asyncio
+import contextlib
+import logging
+import uuid
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+
+import orjson
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "cache_invalidation"
+VERSION_KEY_PREFIX = "cache_invalidation_version"
+
+# The version bump and the message are one atomic step, so messages carry consecutive versions in
+# the order they were published and a worker can tell when it missed one.
+PUBLISH_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', ARGV[1], version .. ' ' .. ARGV[2])
+return version
+"""
+
+
+def _version_key(namespace: str) -> str:
+    return f"{VERSION_KEY_PREFIX}:{namespace}"
+
+
+@dataclass
+class _Namespace:
+    evict: Callable[[list[str]], None]
+    clear: Callable[[], None]
+    version: int | None = None
+
+
+# Keeps in-process caches coherent across workers. A worker that changes shared data publishes
+# the affected keys of a namespace; every other worker evicts them from its local copy. Each
+# namespace has a version counter in Redis, bumped by every message. A worker that sees a version
+# jump, or finds the counter moved after a reconnect, missed messages and clears the namespace.
+class InvalidationBus:
+    def __init__(self, redis: Redis, reconnect_delay: float):
+        self.redis = redis
+        self.reconnect_delay = reconnect_delay
+        self.origin = uuid.uuid4().hex
+        self.received = 0
+        self.cleared = 0
+        self._namespaces: dict[str, _Namespace] = {}
+        self._script = redis.register_script(PUBLISH_SCRIPT)
+        self._task: asyncio.Task[None] | None = None
+
+    def register(
+        self, namespace: str, evict: Callable[[list[str]], None], clear: Callable[[], None]
+    ) -> None:
+        self._namespaces[namespace] = _Namespace(evict, clear)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self) -> dict[str, int]:
+        return {"received": self.received, "cleared": self.cleared}
+
+    async def publish(self, namespace: str, keys: Iterable[str]) -> None:
+        # one message for the whole batch; the publisher has already updated its own copy
+        message = orjson.dumps({"namespace": namespace, "origin": self.origin, "keys": list(keys)})
+        try:
+            await self._script(keys=[_version_key(namespace)], args=[INVALIDATION_CHANNEL, message])
+        except RedisError:
+            logger.warning("Error publishing invalidation of %s", namespace, exc_info=True)
+
+    def handle(self, raw: bytes) -> None:
+        version, _, payload = raw.partition(b" ")
+        message = orjson.loads(payload)
+        if (namespace := self._namespaces.get(message["namespace"])) is None:
+            return
+        self.received += 1
+
+        seen, version = namespace.version, int(version)
+        if seen is not None and version > seen + 1:
+            self._clear(message["namespace"], namespace)
+        elif message["origin"] != self.origin:
+            namespace.evict(message["keys"])
+        if seen is None or version > seen:
+            namespace.version = version
+
+    async def _sync_versions(self) -> None:
+        names = list(self._namespaces)
+        if not names:
+            return
+        versions = await self.redis.mget([_version_key(name) for name in names])
+        for name, raw in zip(names, versions, strict=True):
+            namespace = self._namespaces[name]
+            version = int(raw) if raw is not None else 0
+            if namespace.version is not None and version != namespace.version:
+                self._clear(name, namespace)
+            namespace.version = version
+
+    def _clear(self, name: str, namespace: _Namespace) -> None:
+        logger.info("Missed invalidations of %s, clearing the local copy", name)
+        self.cleared += 1
+        namespace.clear()
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    # subscribed first, so nothing published after the versions are read is lost
+                    await self._sync_versions()
+                    async for message in pubsub.listen():
+                        try:
+                            self.handle(message["data"])
+                        except Exception:
+                            logger.exception("Error handling invalidation %r", message["data"])
+            except RedisError:
+                logger.warning("Invalidation subscription lost, reconnecting", exc_info=True)
+                await asyncio.sleep(self.reconnect_delay)
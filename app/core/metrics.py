@@ -0,0 +1,145 @@
+import functools
+import os
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any, ParamSpec, TypeVar
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+# in-process operations finish in microseconds, NBP and bcrypt take hundreds of milliseconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template and status",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REPOSITORY_OPERATION_DURATION = Histogram(
+    "repository_operation_duration_seconds",
+    "MongoDB repository operation latency",
+    ["collection", "operation"],
+    buckets=LATENCY_BUCKETS,
+)
+EXCHANGE_RATES_LOOKUP_DURATION = Histogram(
+    "exchange_rates_lookup_duration_seconds",
+    "Exchange rates lookup latency by where the rates came from",
+    ["source"],
+    buckets=LATENCY_BUCKETS,
+)
+NBP_REQUEST_DURATION = Histogram(
+    "nbp_request_duration_seconds",
+    "NBP API request latency, one observation per attempt",
+    buckets=LATENCY_BUCKETS,
+)
+PASSWORD_HASH_DURATION = Histogram(
+    "password_hash_duration_seconds",
+    "bcrypt hash and verify latency, including the wait for a worker thread",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+PASSWORD_HASH_QUEUE_DEPTH = Gauge(
+    "password_hash_queue_depth",
+    "bcrypt calls waiting for a free worker thread",
+    multiprocess_mode="livesum",
+)
+APP_STARTUP_DURATION = Gauge(
+    "app_startup_duration_seconds",
+    "Time to import the app in the server master and to run each worker's lifespan startup",
+    ["phase"],
+    multiprocess_mode="max",
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Redis cache lookups by cache and result", ["cache", "result"]
+)
+
+
+class FirstResponseTimer:
+    # time from a worker's lifespan startup until a route first answers successfully
+    def __init__(self, phase: str):
+        self.phase = phase
+        self.seconds: float | None = None
+        self._started: float | None = None
+
+    def start(self, started: float) -> None:
+        self._started = started
+        self.seconds = None
+
+    def record(self) -> None:
+        if self.seconds is not None or self._started is None:
+            return
+        self.seconds = time.perf_counter() - self._started
+        APP_STARTUP_DURATION.labels(self.phase).set(self.seconds)
+
+
+first_wallet_response = FirstResponseTimer("first_wallet_response")
+
+
+def render_metrics() -> bytes:
+    # under app.server every worker writes to PROMETHEUS_MULTIPROC_DIR, aggregated here
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def timed_operation(
+    func: Callable[P, Awaitable[T]],
+) -> Callable[P, Awaitable[T]]:
+    @functools.wraps(func)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            repository: Any = args[0]
+            REPOSITORY_OPERATION_DURATION.labels(repository.collection.name, func.__name__).observe(
+                time.perf_counter() - started
+            )
+
+    return wrapper
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # the route template, not the raw path, keeps label cardinality bounded
+            route = scope.get("route")
+            HTTP_REQUEST_DURATION.labels(
+                scope["method"], getattr(route, "path_format", "unmatched"), status_code
+            ).observe(time.perf_counter() - started)
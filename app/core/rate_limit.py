@@ -0,0 +1,108 @@
+import logging
+import math
+import time
+from dataclasses import dataclass
+
+from cachetools import TLRUCache
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.config import Settings
+from app.core.exceptions import RateLimitExceededError
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_PREFIX = "ratelimit"
+
+# Refills and takes one token from every bucket in KEYS, or from none of them. Returns
+# {allowed, retry_after_ms, index of the bucket that ran dry}.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(state[1]) or capacity
+    local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+    available = math.min(capacity, available + elapsed * rate)
+    if available < 1 then
+        return {0, math.ceil((1 - available) / rate * 1000), i}
+    end
+    tokens[i] = available
+end
+local ttl = math.ceil(capacity / rate * 1000)
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('PEXPIRE', key, ttl)
+end
+return {1, 0, 0}
+"""
+
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    capacity: int
+    period: float
+
+    @classmethod
+    def parse(cls, value: str) -> "RateLimit":
+        count, _, period = value.partition("/")
+        period = period.strip()
+        return cls(int(count), _PERIODS[period] if period in _PERIODS else float(period))
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.period
+
+
+def limits_from_settings(settings: Settings) -> dict[str, RateLimit]:
+    if not settings.RATE_LIMIT_ENABLED:
+        return {}
+    return {
+        "auth": RateLimit.parse(settings.RATE_LIMIT_AUTH),
+        "wallet_read": RateLimit.parse(settings.RATE_LIMIT_WALLET_READ),
+        "wallet_write": RateLimit.parse(settings.RATE_LIMIT_WALLET_WRITE),
+        "rates": RateLimit.parse(settings.RATE_LIMIT_RATES),
+    }
+
+
+def _blocked_until(key: str, deadline: float, now: float) -> float:
+    return deadline
+
+
+class RateLimiter:
+    def __init__(self, redis: Redis, limits: dict[str, RateLimit], blocked_maxsize: int = 10000):
+        self.limits = limits
+        self._script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+        # buckets known to be empty; requests against them are rejected without a round-trip
+        self._blocked: TLRUCache[str, float] = TLRUCache(
+            maxsize=blocked_maxsize, ttu=_blocked_until, timer=time.monotonic
+        )
+
+    async def hit(self, scope: str, identities: list[str]) -> None:
+        limit = self.limits.get(scope)
+        if limit is None or not identities:
+            return
+
+        keys = [f"{RATE_LIMIT_PREFIX}:{scope}:{identity}" for identity in identities]
+        now = time.monotonic()
+        blocked = [until for key in keys if (until := self._blocked.get(key)) is not None]
+        if blocked:
+            raise RateLimitExceededError(max(math.ceil(max(blocked) - now), 1))
+
+        try:
+            allowed, retry_after_ms, index = await self._script(
+                keys=keys, args=[limit.capacity, limit.rate, time.time()]
+            )
+        except RedisError:
+            # fail open: an unreachable Redis must not take the API down with it
+            logger.warning("Rate limiter unavailable", exc_info=True)
+            return
+
+        if not allowed:
+            retry_after = int(retry_after_ms) / 1000
+            self._blocked[keys[int(index) - 1]] = now + retry_after
+            raise RateLimitExceededError(max(math.ceil(retry_after), 1))
@@ -0,0 +1,51 @@
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from fastapi import status
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+
+def _encode_default(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, BaseModel):
+        return dict(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def encode_model(model: BaseModel) -> bytes:
+    # Models built with model_construct from already-quantized values are written as they
+    # are: no validators run again and no intermediate dict copies are made.
+    return orjson.dumps(dict(model), default=_encode_default, option=orjson.OPT_UTC_Z)
+
+
+class RawJSONResponse(Response):
+    """Sends pre-encoded JSON, bypassing the response_model round-trip."""
+
+    media_type = "application/json"
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so a W/ prefix added by a proxy still matches
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+
+def _validator_headers(etag: str) -> dict[str, str]:
+    # clients may keep the body but have to revalidate it before every use
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=_validator_headers(etag))
+
+
+def conditional_json_response(body: bytes, etag: str, if_none_match: str | None) -> Response:
+    if etag_matches(if_none_match, etag):
+        return not_modified_response(etag)
+    return RawJSONResponse(body, headers=_validator_headers(etag))
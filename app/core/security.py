@@ -1,16 +1,25 @@
+import asyncio
+import hashlib
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from typing import Any
+from typing import Any, TypeVar
 
+from cachetools import TLRUCache
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
 from app.config import get_settings
-from app.core.exceptions import AuthenticationError
+from app.core.exceptions import AuthenticationError, ServiceOverloadedError
+from app.core.metrics import PASSWORD_HASH_DURATION, PASSWORD_HASH_QUEUE_DEPTH
 from app.models.utils import get_current_time
 
 settings = get_settings()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+T = TypeVar("T")
+
 
 def create_access_token(data: dict[str, Any]) -> str:
     to_encode = data.copy()
@@ -19,13 +28,62 @@ def create_access_token(data: dict[str, Any]) -> str:
     return jwt.encode(to_encode, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
 
 
+def _token_expiry(key: bytes, payload: dict[str, Any], now: float) -> float:
+    return float(payload.get("exp", now))
+
+
+class TokenCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: TLRUCache[bytes, dict[str, Any]] = TLRUCache(
+            maxsize=max(maxsize, 1), ttu=_token_expiry, timer=time.time
+        )
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    def get(self, token: str) -> dict[str, Any] | None:
+        payload = self._cache.get(self._key(token)) if self.maxsize > 0 else None
+        if payload is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return payload
+
+    def set(self, token: str, payload: dict[str, Any]) -> None:
+        if self.maxsize > 0:
+            self._cache[self._key(token)] = payload
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._cache),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+token_cache = TokenCache(settings.TOKEN_CACHE_MAXSIZE)
+
+
 def verify_token(token: str) -> dict[str, Any]:
+    if (payload := token_cache.get(token)) is not None:
+        return payload
+
     try:
         payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-        return payload
     except JWTError as e:
         raise AuthenticationError() from e
 
+    token_cache.set(token, payload)
+    return payload
+
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
@@ -33,3 +91,55 @@ def get_password_hash(password: str) -> str:
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
+
+
+class PasswordHasher:
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.rejected = 0
+        self._executor: ThreadPoolExecutor | None = None
+
+    async def hash(self, password: str) -> str:
+        with PASSWORD_HASH_DURATION.labels("hash").time():
+            return await self._run(get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        with PASSWORD_HASH_DURATION.labels("verify").time():
+            return await self._run(verify_password, plain_password, hashed_password)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "in_flight": min(self.pending, self.max_workers),
+            "queued": max(self.pending - self.max_workers, 0),
+            "rejected": self.rejected,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        if self.pending >= self.max_workers + self.max_queue:
+            self.rejected += 1
+            raise ServiceOverloadedError()
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="bcrypt")
+
+        self._set_pending(self.pending + 1)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._set_pending(self.pending - 1)
+
+    def _set_pending(self, pending: int) -> None:
+        self.pending = pending
+        PASSWORD_HASH_QUEUE_DEPTH.set(max(pending - self.max_workers, 0))
+
+
+password_hasher = PasswordHasher(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_QUEUE)
@@ -1,18 +1,38 @@
 # app/main.py
 import logging
+import os
+import time
 from collections.abc import AsyncIterator
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.redis import RedisBackend
+from prometheus_client import CONTENT_TYPE_LATEST
 from redis import asyncio as aioredis
 
+from app.api.deps import CurrentAdmin
 from app.api.v1.router import api_router
 from app.config import get_settings
+from app.core.database import PoolStatsListener, create_mongo_client
 from app.core.exceptions import WalletException
+from app.core.idempotency import IdempotencyStore
+from app.core.invalidation import InvalidationBus
+from app.core.metrics import (
+    APP_STARTUP_DURATION,
+    MetricsMiddleware,
+    first_wallet_response,
+    render_metrics,
+)
+from app.core.rate_limit import RateLimiter, limits_from_settings
+from app.core.security import password_hasher, token_cache
+from app.repositories.ledger import LedgerFlusher
+from app.repositories.rates import RateHistoryRepository
+from app.services.coalescer import WriteCoalescer
+from app.services.exchange import ExchangeRateService
+from app.services.wallet_events import WalletEventHub
 
 settings = get_settings()
 
@@ -24,10 +44,61 @@ logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncIterator[None]:
-    redis = aioredis.from_url(settings.REDIS_URL)
-    FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    started = time.perf_counter()
+    first_wallet_response.start(started)
+    app.state.mongo_pool_stats = PoolStatsListener()
+    app.state.mongo_client = create_mongo_client(settings, app.state.mongo_pool_stats)
+    app.state.redis = aioredis.from_url(settings.REDIS_URL)
+    FastAPICache.init(RedisBackend(app.state.redis), prefix="fastapi-cache")
+    app.state.rate_limiter = RateLimiter(app.state.redis, limits_from_settings(settings))
+    app.state.idempotency = IdempotencyStore(
+        app.state.redis,
+        settings.IDEMPOTENCY_TTL,
+        settings.IDEMPOTENCY_LOCK_TIMEOUT,
+        settings.IDEMPOTENCY_POLL_INTERVAL,
+    )
+    app.state.invalidation = InvalidationBus(app.state.redis, settings.INVALIDATION_RECONNECT_DELAY)
+    app.state.exchange_service = ExchangeRateService(
+        history=RateHistoryRepository(app.state.mongo_client.wallet_app.exchange_rate_tables),
+        invalidation=app.state.invalidation,
+    )
+    app.state.invalidation.start()
+    if snapshot := await app.state.exchange_service.warm():
+        logger.info("Warmed exchange rates with table %s", snapshot.effective_date)
+    app.state.exchange_service.start()
+    app.state.wallet_events = WalletEventHub(
+        app.state.redis,
+        settings.WALLET_EVENTS_KEEPALIVE,
+        settings.WALLET_EVENTS_RECONNECT_DELAY,
+        settings.WALLET_EVENTS_NOTIFY_SPREAD,
+    )
+    app.state.wallet_events.start()
+    app.state.exchange_service.add_table_listener(
+        lambda _: app.state.wallet_events.notify_all(reload=False)
+    )
+    app.state.ledger_flusher = LedgerFlusher(
+        settings.LEDGER_FLUSH_WORKERS, settings.LEDGER_FLUSH_MAX_QUEUE
+    )
+    app.state.ledger_flusher.start()
+    app.state.write_coalescer = (
+        WriteCoalescer(
+            settings.WRITE_COALESCING_WINDOW_MS / 1000, settings.WRITE_COALESCING_MAX_BATCH
+        )
+        if settings.WRITE_COALESCING_ENABLED
+        else None
+    )
+
+    app.state.startup_seconds = time.perf_counter() - started
+    APP_STARTUP_DURATION.labels("lifespan").set(app.state.startup_seconds)
+    logger.info("Worker %d started in %.3fs", os.getpid(), app.state.startup_seconds)
     yield
-    await redis.close()
+    await app.state.ledger_flusher.close()
+    await app.state.invalidation.close()
+    await app.state.wallet_events.close()
+    await app.state.exchange_service.close()
+    await app.state.redis.close()
+    app.state.mongo_client.close()
+    password_hasher.shutdown()
 
 
 def create_application() -> FastAPI:
@@ -47,21 +118,51 @@ def create_application() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    if settings.METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware)
 
     @app.exception_handler(WalletException)
     async def wallet_exception_handler(request: Request, exc: WalletException) -> JSONResponse:
         return JSONResponse(
-            status_code=exc.status_code, content={"code": exc.code, "message": exc.detail}
+            status_code=exc.status_code,
+            content={"code": exc.code, "message": exc.detail},
+            headers=exc.headers,
         )
 
     app.include_router(api_router, prefix=settings.API_V1_STR)
 
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics() -> Response:
+        return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+    @app.get("/health")
+    async def health_check():
+        return {"status": "healthy"}
+
+    # pool sizes, queue depths and circuit state show when the service is easiest to overload,
+    # so only admins may read them; the bcrypt queue depth is also on /metrics for alerting
+    @app.get("/health/stats")
+    async def health_stats(request: Request, current_admin: CurrentAdmin):
+        return {
+            "startup_seconds": round(request.app.state.startup_seconds, 3),
+            "first_wallet_response_seconds": (
+                round(seconds, 3)
+                if (seconds := first_wallet_response.seconds) is not None
+                else None
+            ),
+            "mongo_pool": request.app.state.mongo_pool_stats.snapshot(),
+            "password_hasher": password_hasher.stats(),
+            "token_cache": token_cache.stats(),
+            "nbp_circuit": request.app.state.exchange_service.breaker.stats(),
+            "wallet_events": request.app.state.wallet_events.stats(),
+            "invalidation": request.app.state.invalidation.stats(),
+            "ledger_flusher": request.app.state.ledger_flusher.stats(),
+            "write_coalescer": (
+                coalescer.stats() if (coalescer := request.app.state.write_coalescer) else None
+            ),
+        }
+
     return app
 
 
 app = create_application()
-
-
-@app.get("/health")
-async def health_check():
-    return {"status": "healthy"}
@@ -0,0 +1,12 @@
+from datetime import datetime
+from decimal import Decimal
+
+from pydantic import BaseModel
+
+
+class LedgerEntry(BaseModel):
+    seq: int
+    currency: str
+    amount: Decimal
+    balance_after: Decimal
+    created_at: datetime
@@ -0,0 +1,60 @@
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+
+from app.models.utils import get_current_time
+
+
+@dataclass(frozen=True)
+class RatesSnapshot:
+    rates: dict[str, Decimal]
+    effective_date: str | None
+    fetched_at: datetime
+    # set when NBP is unreachable and an older table is served in place of a current one
+    stale: bool = False
+
+    @property
+    def age(self) -> float:
+        return (get_current_time() - self.fetched_at).total_seconds()
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "rates": {code: str(rate) for code, rate in self.rates.items()},
+                "effective_date": self.effective_date,
+                "fetched_at": self.fetched_at.isoformat(),
+            }
+        )
+
+    @classmethod
+    def from_json(cls, raw: str | bytes) -> "RatesSnapshot":
+        data = json.loads(raw)
+        return cls(
+            rates={code: Decimal(rate) for code, rate in data["rates"].items()},
+            effective_date=data["effective_date"],
+            fetched_at=datetime.fromisoformat(data["fetched_at"]),
+        )
+
+
+@dataclass(frozen=True)
+class CrossRates:
+    snapshot: RatesSnapshot
+    matrix: dict[str, dict[str, Decimal]]
+
+    @classmethod
+    def from_snapshot(cls, snapshot: RatesSnapshot) -> "CrossRates":
+        # table C quotes every currency in PLN, so source -> target goes through PLN once here
+        # instead of on every quote. Rates keep the full quotient: a fixed number of decimal
+        # places would throw away most of the digits of a rate like HUF -> EUR, and only the
+        # converted amount is rounded.
+        rates = {"PLN": Decimal("1"), **snapshot.rates}
+        matrix = {
+            source: {target: source_rate / target_rate for target, target_rate in rates.items()}
+            for source, source_rate in rates.items()
+        }
+        return cls(snapshot=snapshot, matrix=matrix)
+
+    def rate(self, source: str, target: str) -> Decimal | None:
+        row = self.matrix.get(source)
+        return row.get(target) if row else None
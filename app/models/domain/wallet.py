@@ -1,7 +1,7 @@
 from datetime import datetime
 from decimal import Decimal
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, PrivateAttr, field_validator
 
 from app.models.utils import generate_objectid, get_current_time, quantize_decimal
 
@@ -12,6 +12,15 @@ class Wallet(BaseModel):
     balances: dict[str, Decimal] = Field(default_factory=dict)
     created_at: datetime = Field(default_factory=get_current_time)
     updated_at: datetime = Field(default_factory=get_current_time)
+    # bumped by every update of the document; None for a state that was never stored on its own,
+    # like the wallet between two coalesced requests
+    version: int | None = None
+    # currencies the update that returned this wallet added to it
+    _created_currencies: frozenset[str] = PrivateAttr(frozenset())
+
+    @property
+    def created_currencies(self) -> frozenset[str]:
+        return self._created_currencies
 
     @field_validator("balances")
     @classmethod
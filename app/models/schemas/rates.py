@@ -0,0 +1,38 @@
+from decimal import Decimal
+
+from pydantic import BaseModel, Field, field_validator
+
+from app.models.utils import quantize_decimal
+
+
+class ConversionRequest(BaseModel):
+    model_config = {"populate_by_name": True}
+
+    from_currency: str = Field(alias="from", min_length=3, max_length=3)
+    to_currency: str = Field(alias="to", min_length=3, max_length=3)
+    amount: Decimal = Field(gt=0)
+
+    @field_validator("amount")
+    @classmethod
+    def validate_amount(cls, v: Decimal) -> Decimal:
+        return quantize_decimal(v)
+
+
+class ConversionBatchRequest(BaseModel):
+    conversions: list[ConversionRequest] = Field(min_length=1, max_length=100)
+
+
+class ConversionQuote(BaseModel):
+    model_config = {"populate_by_name": True}
+
+    from_currency: str = Field(alias="from")
+    to_currency: str = Field(alias="to")
+    amount: Decimal
+    rate: Decimal
+    converted: Decimal
+
+
+class ConversionResponse(BaseModel):
+    quotes: list[ConversionQuote]
+    effective_date: str | None
+    rates_stale: bool = False
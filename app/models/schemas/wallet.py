@@ -1,6 +1,8 @@
+from datetime import date, datetime
 from decimal import Decimal
+from typing import Literal
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, PrivateAttr, field_validator
 
 from app.models.utils import quantize_decimal
 
@@ -15,10 +17,32 @@ class WalletOperation(BaseModel):
         return quantize_decimal(v)
 
 
+class WalletBatchItem(WalletOperation):
+    operation: Literal["add", "subtract"]
+
+
+class WalletBatchRequest(BaseModel):
+    operations: list[WalletBatchItem] = Field(min_length=1, max_length=100)
+
+
 class WalletResponse(BaseModel):
     balances: dict[str, Decimal]
     pln_values: dict[str, Decimal]
     total_pln: Decimal
+    # true while NBP is unreachable and pln_values come from the last table fetched
+    rates_stale: bool = False
+    # identifies this valuation for conditional GETs; not part of the body
+    _etag: str | None = PrivateAttr(None)
+    # version of the wallet document valued here, orders writes to the response cache
+    _version: int | None = PrivateAttr(None)
+
+    @property
+    def etag(self) -> str | None:
+        return self._etag
+
+    @property
+    def version(self) -> int | None:
+        return self._version
 
     @field_validator("pln_values", "balances")
     @classmethod
@@ -35,3 +59,27 @@ class WalletBalanceResponse(BaseModel):
     currency: str
     amount: Decimal
     pln_value: Decimal
+
+
+class TransactionResponse(BaseModel):
+    seq: int
+    currency: str
+    amount: Decimal
+    balance_after: Decimal
+    created_at: datetime
+
+
+class TransactionPage(BaseModel):
+    items: list[TransactionResponse]
+    next_before: int | None = None
+
+
+class ValuationPoint(BaseModel):
+    date: date
+    balances: dict[str, Decimal]
+    pln_values: dict[str, Decimal]
+    total_pln: Decimal
+
+
+class ValuationHistory(BaseModel):
+    points: list[ValuationPoint]
@@ -16,3 +16,19 @@ def quantize_decimal(amount: Decimal | str | int | float) -> Decimal:
     if not isinstance(amount, Decimal):
         amount = Decimal(str(amount))
     return amount.quantize(Decimal("0.01"))
+
+
+MINOR_UNIT_EXPONENT = 2
+
+
+def to_minor_units(amount: Decimal) -> int:
+    return int(quantize_decimal(amount).scaleb(MINOR_UNIT_EXPONENT))
+
+
+def from_minor_units(value: int) -> Decimal:
+    return Decimal(value).scaleb(-MINOR_UNIT_EXPONENT)
+
+
+def ensure_utc(value: datetime) -> datetime:
+    # pymongo hands back naive datetimes that are UTC
+    return value if value.tzinfo is not None else value.replace(tzinfo=UTC)
@@ -3,6 +3,8 @@ from typing import Generic, TypeVar
 from motor.motor_asyncio import AsyncIOMotorCollection
 from pydantic import BaseModel
 
+from app.core.metrics import timed_operation
+
 ModelType = TypeVar("ModelType", bound=BaseModel)
 
 
@@ -11,17 +13,20 @@ class BaseRepository(Generic[ModelType]):
         self.collection = collection
         self.model = model
 
+    @timed_operation
     async def find_one(self, query: dict) -> ModelType | None:
         result = await self.collection.find_one(query)
         if result:
             return self.model.model_validate(result)
         return None
 
+    @timed_operation
     async def find_many(self, query: dict) -> list[ModelType]:
         cursor = self.collection.find(query)
         results = await cursor.to_list(length=None)
         return [self.model.model_validate(doc) for doc in results]
 
+    @timed_operation
     async def create(self, document: ModelType) -> ModelType:
         doc_dict = document.model_dump(exclude={"id"})
         if hasattr(document, "created_at"):
@@ -32,6 +37,7 @@ class BaseRepository(Generic[ModelType]):
         result = await self.collection.insert_one(doc_dict)
         return await self.find_one({"_id": result.inserted_id})
 
+    @timed_operation
     async def update(self, query: dict, update_data: dict) -> ModelType | None:
         result = await self.collection.find_one_and_update(
             query, {"$set": update_data}, return_document=True
@@ -40,6 +46,7 @@ class BaseRepository(Generic[ModelType]):
             return self.model.model_validate(result)
         return None
 
+    @timed_operation
     async def delete(self, query: dict) -> bool:
         result = await self.collection.delete_one(query)
         return result.deleted_count > 0
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import BulkWriteError
+
+from app.models.domain.ledger import LedgerEntry
+from app.models.utils import from_minor_units, get_current_time
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+FlushJob = Callable[[], Awaitable[None]]
+
+
+class LedgerRepository:
+    def __init__(
+        self,
+        entries: AsyncIOMotorCollection,
+        snapshots: AsyncIOMotorCollection,
+        snapshot_interval: int,
+    ):
+        self.entries = entries
+        self.snapshots = snapshots
+        self.snapshot_interval = snapshot_interval
+
+    async def ensure_indexes(self) -> None:
+        await self.entries.create_index([("user_id", 1), ("seq", 1)], unique=True)
+        await self.snapshots.create_index([("user_id", 1), ("seq", 1)], unique=True)
+
+    async def flush(self, wallet: dict[str, Any], balances: dict[str, int]) -> None:
+        # The wallet update pushed its entries onto pending_entries atomically with the balance
+        # change. pending_entries is always the contiguous tail ending at the wallet's seq, so
+        # every entry's seq and running balance follow from its position.
+        pending = wallet.get("pending_entries") or []
+        if not pending:
+            return
+
+        user_id = wallet["user_id"]
+        last_seq = wallet["seq"]
+        first_seq = last_seq - len(pending) + 1
+        running = dict(balances)
+        documents = []
+        for offset, entry in reversed(list(enumerate(pending))):
+            currency = entry["currency"]
+            documents.append(
+                {
+                    **entry,
+                    "user_id": user_id,
+                    "seq": first_seq + offset,
+                    "balance_after": running.get(currency, 0),
+                }
+            )
+            running[currency] = running.get(currency, 0) - entry["amount"]
+        documents.reverse()
+
+        try:
+            await self.entries.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # a concurrent flush of the same tail already stored these entries
+            if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+                raise
+
+        if first_seq == 1:
+            await self.save_snapshot(user_id, 0, running)
+        if last_seq // self.snapshot_interval > (first_seq - 1) // self.snapshot_interval:
+            await self.save_snapshot(user_id, last_seq, balances)
+
+    async def list_entries(
+        self, user_id: str, limit: int, before: int | None = None
+    ) -> list[LedgerEntry]:
+        query: dict = {"user_id": user_id}
+        if before is not None:
+            query["seq"] = {"$lt": before}
+        cursor = self.entries.find(query).sort("seq", -1).limit(limit)
+        return [_to_entry(document) async for document in cursor]
+
+    async def rebuild_balances(self, user_id: str, at_seq: int | None = None) -> dict[str, int]:
+        seq_filter: dict = {} if at_seq is None else {"$lte": at_seq}
+        snapshot_query: dict = {"user_id": user_id}
+        if seq_filter:
+            snapshot_query["seq"] = seq_filter
+        snapshot = await self.snapshots.find_one(snapshot_query, sort=[("seq", -1)])
+
+        balances: dict[str, int] = dict(snapshot["balances"]) if snapshot else {}
+        tail_filter = {"$gt": snapshot["seq"] if snapshot else 0, **seq_filter}
+        cursor = self.entries.find({"user_id": user_id, "seq": tail_filter}).sort("seq", 1)
+        async for entry in cursor:
+            balances[entry["currency"]] = balances.get(entry["currency"], 0) + entry["amount"]
+        return balances
+
+    async def latest_snapshot_seq(self, user_id: str) -> int | None:
+        snapshot = await self.snapshots.find_one(
+            {"user_id": user_id}, {"seq": 1}, sort=[("seq", -1)]
+        )
+        return snapshot["seq"] if snapshot else None
+
+    async def latest_snapshot_seqs(self) -> dict[str, int]:
+        # one pass over the snapshots for maintenance jobs, instead of one query per wallet
+        cursor = self.snapshots.aggregate(
+            [{"$group": {"_id": "$user_id", "seq": {"$max": "$seq"}}}]
+        )
+        return {row["_id"]: row["seq"] async for row in cursor}
+
+    async def save_snapshot(self, user_id: str, seq: int, balances: dict[str, int]) -> None:
+        await self.snapshots.update_one(
+            {"user_id": user_id, "seq": seq},
+            {"$setOnInsert": {"balances": balances, "created_at": get_current_time()}},
+            upsert=True,
+        )
+
+
+# Moves ledger entries out of the wallet outbox after the response has been sent. A wallet update
+# queues its flush and returns; a few workers insert the entries and pull them off
+# pending_entries. A flush that fails leaves its entries pending, where the wallet's next flush
+# or compact_ledger picks them up.
+class LedgerFlusher:
+    def __init__(self, workers: int, max_queued: int):
+        self.workers = workers
+        self.flushed = 0
+        self.failed = 0
+        self._queue: asyncio.Queue[FlushJob] = asyncio.Queue(max_queued)
+        self._tasks: list[asyncio.Task[None]] = []
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        # flushes queued before shutdown still run
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict[str, int]:
+        return {"queued": self._queue.qsize(), "flushed": self.flushed, "failed": self.failed}
+
+    async def submit(self, flush: FlushJob) -> None:
+        if self._tasks and not self._queue.full():
+            self._queue.put_nowait(flush)
+            return
+        # the workers are not running or have fallen behind, the request flushes its own entries
+        await flush()
+
+    async def _work(self) -> None:
+        while True:
+            flush = await self._queue.get()
+            try:
+                await flush()
+                self.flushed += 1
+            except Exception:
+                self.failed += 1
+                logger.warning("Error flushing ledger entries, left pending", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+
+def _to_entry(document: dict[str, Any]) -> LedgerEntry:
+    return LedgerEntry(
+        seq=document["seq"],
+        currency=document["currency"],
+        amount=from_minor_units(document["amount"]),
+        balance_after=from_minor_units(document["balance_after"]),
+        created_at=document["created_at"],
+    )
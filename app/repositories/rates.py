@@ -0,0 +1,53 @@
+from datetime import date
+from decimal import Decimal
+from typing import Any
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from app.models.domain.rates import RatesSnapshot
+from app.models.utils import ensure_utc
+
+
+def document_to_snapshot(document: dict[str, Any]) -> RatesSnapshot:
+    return RatesSnapshot(
+        rates={code: Decimal(rate) for code, rate in document["rates"].items()},
+        effective_date=document["effective_date"],
+        fetched_at=ensure_utc(document["fetched_at"]),
+    )
+
+
+class RateHistoryRepository:
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+
+    async def ensure_indexes(self) -> None:
+        await self.collection.create_index("effective_date", unique=True)
+
+    async def save_table(self, snapshot: RatesSnapshot) -> None:
+        await self.collection.update_one(
+            {"effective_date": snapshot.effective_date},
+            {
+                "$set": {
+                    "rates": {code: str(rate) for code, rate in snapshot.rates.items()},
+                    "fetched_at": snapshot.fetched_at,
+                }
+            },
+            upsert=True,
+        )
+
+    async def get_as_of(self, as_of: date) -> RatesSnapshot | None:
+        # served by the unique effective_date index: one descending seek, no scan
+        document = await self.collection.find_one(
+            {"effective_date": {"$lte": as_of.isoformat()}}, sort=[("effective_date", -1)]
+        )
+        return document_to_snapshot(document) if document else None
+
+    async def get_latest(self) -> RatesSnapshot | None:
+        document = await self.collection.find_one({}, sort=[("effective_date", -1)])
+        return document_to_snapshot(document) if document else None
+
+    async def latest_effective_date(self) -> date | None:
+        document = await self.collection.find_one(
+            {}, {"effective_date": 1}, sort=[("effective_date", -1)]
+        )
+        return date.fromisoformat(document["effective_date"]) if document else None
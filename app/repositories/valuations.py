@@ -0,0 +1,51 @@
+from datetime import date
+from typing import Any
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from app.models.schemas.wallet import ValuationPoint
+from app.models.utils import from_minor_units
+
+
+class ValuationRepository:
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+
+    async def ensure_indexes(self) -> None:
+        await self.collection.create_index([("user_id", 1), ("date", 1)], unique=True)
+
+    async def save_many(self, day: date, documents: list[dict[str, Any]]) -> None:
+        if not documents:
+            return
+        # replace the day's points so a re-run of the job stays idempotent
+        await self.collection.delete_many(
+            {"date": day.isoformat(), "user_id": {"$in": [doc["user_id"] for doc in documents]}}
+        )
+        await self.collection.insert_many(
+            [{**document, "date": day.isoformat()} for document in documents]
+        )
+
+    async def get_series(self, user_id: str, start: date, end: date) -> list[ValuationPoint]:
+        # Points are only stored on days the valuation changed. Walking the (user_id, date)
+        # index backwards from `end` picks up the point in effect on `start` in the same query.
+        cursor = self.collection.find({"user_id": user_id, "date": {"$lte": end.isoformat()}}).sort(
+            "date", -1
+        )
+        points: list[ValuationPoint] = []
+        async for document in cursor:
+            point = _to_point(document)
+            if point.date < start:
+                points.append(point.model_copy(update={"date": start}))
+                break
+            points.append(point)
+        points.reverse()
+        return points
+
+
+def _to_point(document: dict[str, Any]) -> ValuationPoint:
+    return ValuationPoint(
+        date=date.fromisoformat(document["date"]),
+        balances={c: from_minor_units(v) for c, v in document["balances"].items()},
+        pln_values={c: from_minor_units(v) for c, v in document["pln_values"].items()},
+        total_pln=from_minor_units(document["total_pln"]),
+    )
@@ -1,44 +1,249 @@
+import functools
+from collections.abc import AsyncIterator
+from datetime import datetime
 from decimal import Decimal
+from typing import Any
 
+from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
 
+from app.core.metrics import timed_operation
 from app.models.domain.wallet import Wallet
-from app.models.utils import get_current_time
+from app.models.utils import (
+    ensure_utc,
+    from_minor_units,
+    get_current_time,
+    quantize_decimal,
+    to_minor_units,
+)
+from app.repositories.ledger import LedgerFlusher, LedgerRepository
+
+MAX_GUARD_ATTEMPTS = 3
+
+
+class InsufficientBalanceError(ValueError):
+    def __init__(self, currency: str):
+        super().__init__("Insufficient funds")
+        self.currency = currency
+
+
+def decode_balances(document: dict[str, Any]) -> dict[str, Decimal]:
+    # Balances live in "balances_minor" as int64 minor units. Wallets not yet migrated
+    # still carry the legacy float "balances" map, which is folded in on read.
+    balances = {
+        currency: from_minor_units(value)
+        for currency, value in document.get("balances_minor", {}).items()
+    }
+    for currency, value in document.get("balances", {}).items():
+        balances[currency] = balances.get(currency, Decimal("0.00")) + quantize_decimal(value)
+    return balances
+
+
+def document_to_wallet(document: dict[str, Any]) -> Wallet:
+    fields = {
+        "user_id": document["user_id"],
+        "balances": decode_balances(document),
+        "version": document.get("version", 0),
+    }
+    for field in ("created_at", "updated_at"):
+        if field in document:
+            fields[field] = ensure_utc(document[field])
+    # balances are already exact to the minor unit, so model validation is skipped
+    return Wallet.model_construct(**fields)
+
+
+def _after_update(
+    previous: dict[str, Any], totals: dict[str, int], now: datetime, entries: list[dict[str, Any]]
+) -> dict[str, Any]:
+    # the fields apply_operations changes, as the update left them
+    balances = dict(previous.get("balances_minor", {}))
+    for currency, amount in totals.items():
+        balances[currency] = balances.get(currency, 0) + amount
+    document = {
+        **previous,
+        "balances_minor": balances,
+        "updated_at": now,
+        "version": previous.get("version", 0) + 1,
+    }
+    if entries:
+        document["seq"] = previous.get("seq", 0) + len(entries)
+        document["pending_entries"] = [*previous.get("pending_entries", []), *entries]
+    return document
 
 
 class WalletRepository:
-    def __init__(self, collection: AsyncIOMotorCollection):
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        ledger: LedgerRepository | None = None,
+        flusher: LedgerFlusher | None = None,
+    ):
         self.collection = collection
+        self.ledger = ledger
+        # without a flusher, entries are moved to the ledger before apply_operations returns
+        self.flusher = flusher
 
+    @timed_operation
     async def get_wallet(self, user_id: str) -> Wallet | None:
         result = await self.collection.find_one({"user_id": user_id})
-        return Wallet.model_validate(result) if result else None
+        return document_to_wallet(result) if result else None
+
+    async def iter_wallets(self, batch_size: int) -> AsyncIterator[list[Wallet]]:
+        cursor = self.collection.find(
+            {}, {"user_id": 1, "balances": 1, "balances_minor": 1, "updated_at": 1, "version": 1}
+        ).batch_size(batch_size)
+        chunk: list[Wallet] = []
+        async for document in cursor:
+            chunk.append(document_to_wallet(document))
+            if len(chunk) >= batch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
     async def update_balance(
         self, user_id: str, currency: str, amount: Decimal, subtract: bool = False
     ) -> Wallet:
-        amount_float = float(amount)
+        return await self.apply_operations(user_id, [(currency, -amount if subtract else amount)])
+
+    @timed_operation
+    async def apply_operations(self, user_id: str, operations: list[tuple[str, Decimal]]) -> Wallet:
+        # Signed amounts are applied in order as one conditional update: each currency is
+        # guarded by the lowest point its running total reaches, so no step can overdraw.
+        totals: dict[str, int] = {}
+        required: dict[str, int] = {}
+        for currency, amount in operations:
+            totals[currency] = totals.get(currency, 0) + to_minor_units(amount)
+            if totals[currency] < 0:
+                required[currency] = max(required.get(currency, 0), -totals[currency])
 
-        if not subtract:
-            update = {
-                "$inc": {f"balances.{currency}": amount_float},
-                "$set": {"updated_at": get_current_time()},
-                "$setOnInsert": {"user_id": user_id, "created_at": get_current_time()},
+        query: dict = {"user_id": user_id}
+        if required:
+            query["balances"] = {"$exists": False}
+            query.update(
+                {
+                    f"balances_minor.{currency}": {"$gte": amount}
+                    for currency, amount in required.items()
+                }
+            )
+        # BSON keeps milliseconds, and the wallet returned below must match the stored one
+        now = get_current_time()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        update: dict = {
+            "$inc": {
+                **{f"balances_minor.{currency}": amount for currency, amount in totals.items()},
+                "version": 1,
+            },
+            "$set": {"updated_at": now},
+        }
+        if not required:
+            update["$setOnInsert"] = {"user_id": user_id, "created_at": now}
+
+        # ledger entries ride along in the same single-document update (outbox), and are
+        # moved to the ledger collection off the request path
+        entries = [
+            {
+                "_id": ObjectId(),
+                "currency": currency,
+                "amount": to_minor_units(amount),
+                "created_at": now,
             }
-            result = await self.collection.find_one_and_update(
-                {"user_id": user_id}, update, upsert=True, return_document=True
+            for currency, amount in operations
+            if amount and self.ledger is not None
+        ]
+        if entries:
+            update["$inc"]["seq"] = len(entries)
+            update["$push"] = {"pending_entries": {"$each": entries}}
+
+        for _ in range(MAX_GUARD_ATTEMPTS):
+            # Only the document from before the update tells which currencies the update
+            # created; the updated document is rebuilt from it.
+            previous = await self.collection.find_one_and_update(
+                query, update, upsert=not required, return_document=ReturnDocument.BEFORE
             )
-        else:  # subtract
-            result = await self.collection.find_one_and_update(
-                {"user_id": user_id, f"balances.{currency}": {"$gte": amount_float}},
-                {
-                    "$inc": {f"balances.{currency}": -amount_float},
-                    "$set": {"updated_at": get_current_time()},
-                },
-                return_document=True,
+            if previous or not required:
+                result = _after_update(
+                    previous or {"user_id": user_id, "created_at": now}, totals, now, entries
+                )
+                wallet = document_to_wallet(result)
+                wallet._created_currencies = frozenset(
+                    totals.keys() - decode_balances(previous or {}).keys()
+                )
+                if entries and self.flusher is not None:
+                    await self.flusher.submit(functools.partial(self.flush_ledger, result, wallet))
+                elif entries:
+                    await self.flush_ledger(result, wallet)
+                return wallet
+
+            # the guard can also miss because the wallet still holds legacy float balances
+            legacy = await self.collection.find_one(
+                {"user_id": user_id, "balances": {"$exists": True}}
             )
+            if legacy:
+                await self.migrate_legacy_balances(legacy)
+
+            short_currency = await self._find_short_currency(user_id, required)
+            if short_currency:
+                raise InsufficientBalanceError(short_currency)
 
-            if not result:
-                raise ValueError("Insufficient funds")
+        raise InsufficientBalanceError(next(iter(required)))
+
+    @timed_operation
+    async def flush_ledger(self, document: dict[str, Any], wallet: Wallet | None = None) -> None:
+        if self.ledger is None or not document.get("pending_entries"):
+            return
+
+        wallet = wallet or document_to_wallet(document)
+        balances = {
+            currency: to_minor_units(amount) for currency, amount in wallet.balances.items()
+        }
+        await self.ledger.flush(document, balances)
+        # the document of a newly created wallet is built locally and has no _id
+        await self.collection.update_one(
+            {"user_id": document["user_id"]},
+            {
+                "$pull": {
+                    "pending_entries": {
+                        "_id": {"$in": [entry["_id"] for entry in document["pending_entries"]]}
+                    }
+                }
+            },
+        )
+
+    async def flush_pending_ledger(self, user_id: str) -> None:
+        # entries whose flush is still queued, so a reader sees its own writes
+        document = await self.collection.find_one(
+            {"user_id": user_id, "pending_entries.0": {"$exists": True}}
+        )
+        if document:
+            await self.flush_ledger(document)
+
+    @timed_operation
+    async def migrate_legacy_balances(self, document: dict[str, Any]) -> bool:
+        # Compare-and-set on the legacy map, so $inc's racing with the migration are not lost.
+        while "balances" in document:
+            legacy = document["balances"]
+            update: dict = {"$unset": {"balances": ""}}
+            if legacy:
+                update["$inc"] = {
+                    f"balances_minor.{currency}": to_minor_units(quantize_decimal(value))
+                    for currency, value in legacy.items()
+                }
+            result = await self.collection.update_one(
+                {"_id": document["_id"], "balances": legacy}, update
+            )
+            if result.modified_count:
+                return True
+            document = await self.collection.find_one({"_id": document["_id"]}, {"balances": 1})
+            if document is None:
+                break
+        return False
 
-        return Wallet.model_validate(result)
+    async def _find_short_currency(self, user_id: str, required: dict[str, int]) -> str | None:
+        wallet = await self.get_wallet(user_id)
+        balances = wallet.balances if wallet else {}
+        for currency, amount in required.items():
+            if to_minor_units(balances.get(currency, Decimal("0"))) < amount:
+                return currency
+        return None
@@ -0,0 +1,91 @@
+"""Production server: a gunicorn master forking WEB_CONCURRENCY uvicorn workers.
+
+The app is imported once in the master before forking. Every worker then runs its own lifespan,
+so MongoDB, Redis and HTTP pools are never shared across processes. Send SIGHUP to replace the
+workers gracefully. To deploy new code, send SIGUSR2 to start a new master, then SIGQUIT to the
+old one.
+
+Usage: python -m app.server
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, ClassVar
+
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker
+
+from app.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+class Worker(UvicornWorker):
+    # "auto" picks uvloop and httptools when they are installed
+    CONFIG_KWARGS: ClassVar[dict[str, Any]] = {"loop": "auto", "http": "auto", "lifespan": "on"}
+
+
+def _child_exit(server: Any, worker: Any) -> None:
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def _on_exit(server: Any) -> None:
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+
+
+class Server(BaseApplication):
+    def __init__(self, application: Any, options: dict[str, Any]):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self) -> Any:
+        return self.application
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    # every worker writes its metrics here, and /metrics aggregates them; this has to be set
+    # before prometheus_client is first imported
+    options: dict[str, Any] = {}
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+        options["on_exit"] = _on_exit
+
+    started = time.perf_counter()
+    from app.core.metrics import APP_STARTUP_DURATION
+    from app.main import app
+
+    import_seconds = time.perf_counter() - started
+    APP_STARTUP_DURATION.labels("import").set(import_seconds)
+    logger.info("Application imported in %.3fs", import_seconds)
+
+    options.update(
+        {
+            "bind": f"{settings.HOST}:{settings.PORT}",
+            "workers": settings.WEB_CONCURRENCY,
+            "worker_class": f"{__name__}.Worker",
+            "preload_app": True,
+            "timeout": settings.WORKER_TIMEOUT,
+            "graceful_timeout": settings.GRACEFUL_TIMEOUT,
+            "keepalive": settings.KEEPALIVE_TIMEOUT,
+            "forwarded_allow_ips": settings.FORWARDED_ALLOW_IPS,
+            "child_exit": _child_exit,
+        }
+    )
+    Server(app, options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from app.core.exceptions import AuthenticationError
-from app.core.security import create_access_token, get_password_hash, verify_password
+from app.core.security import create_access_token, password_hasher
 from app.models.domain.user import User
 from app.models.schemas.auth import UserCreate, UserLogin
 from app.repositories.base import BaseRepository
@@ -14,21 +14,21 @@ class AuthService:
         if existing_user:
             raise AuthenticationError()
 
-        hashed_password = get_password_hash(user_data.password)
-        user = User(email=user_data.email, hashed_password=hashed_password)
+        hashed_password = await password_hasher.hash(user_data.password)
+        user = await self.user_repository.create(
+            User(email=user_data.email, hashed_password=hashed_password)
+        )
 
-        await self.user_repository.create(user)
+        access_token = create_access_token({"sub": str(user.id), "email": user.email})
 
-        return await self.authenticate_user(
-            UserLogin(email=user_data.email, password=user_data.password)
-        )
+        return user, access_token
 
     async def authenticate_user(self, user_data: UserLogin) -> tuple[User, str]:
         user = await self.user_repository.find_one({"email": user_data.email})
         if not user:
             raise AuthenticationError()
 
-        if not verify_password(user_data.password, user.hashed_password):
+        if not await password_hasher.verify(user_data.password, user.hashed_password):
             raise AuthenticationError()
 
         access_token = create_access_token({"sub": str(user.id), "email": user.email})
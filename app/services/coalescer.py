@@ -0,0 +1,134 @@
+import asyncio
+import contextlib
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from app.models.domain.wallet import Wallet
+from app.repositories.wallet import InsufficientBalanceError
+
+Operations = list[tuple[str, Decimal]]
+ApplyOperations = Callable[[str, Operations], Awaitable[Wallet]]
+
+
+@dataclass
+class _PendingWrites:
+    requests: list[tuple[Operations, asyncio.Future[Wallet]]] = field(default_factory=list)
+    full: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+def _wallet_after(final: Wallet, index: int, requests: list[Operations]) -> Wallet:
+    # All requests were applied in order by one update, so the wallet right after a request
+    # is the final wallet minus everything the later requests changed. A currency the update
+    # created that no request up to this one touched did not exist yet.
+    balances = dict(final.balances)
+    earlier = {currency for operations in requests[: index + 1] for currency, _ in operations}
+    for operations in requests[index + 1 :]:
+        for currency, amount in operations:
+            balances[currency] -= amount
+    return Wallet.model_construct(
+        user_id=final.user_id,
+        balances={
+            currency: amount
+            for currency, amount in balances.items()
+            if currency in earlier or currency not in final.created_currencies
+        },
+        created_at=final.created_at,
+        updated_at=final.updated_at,
+        # only the last request's wallet is the stored document
+        version=final.version if index == len(requests) - 1 else None,
+    )
+
+
+def _resolve(future: asyncio.Future[Wallet], result: Wallet | BaseException) -> None:
+    # a caller that was cancelled while waiting still has its operations applied
+    if future.done():
+        return
+    if isinstance(result, BaseException):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+# Merges wallet writes for the same user that arrive within a short window. The merged
+# operations go to the repository as one ordered update, which guards every subtraction at the
+# lowest point its currency reaches. If that update is refused, the requests are replayed one
+# by one, so only the ones that overdraw fail.
+class WriteCoalescer:
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.coalesced = 0
+        self._pending: dict[str, _PendingWrites] = {}
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    async def submit(self, user_id: str, operations: Operations, apply: ApplyOperations) -> Wallet:
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = self._pending[user_id] = _PendingWrites()
+            task = asyncio.create_task(self._flush_after_window(user_id, pending, apply))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        future: asyncio.Future[Wallet] = asyncio.get_running_loop().create_future()
+        pending.requests.append((operations, future))
+        if len(pending.requests) >= self.max_batch:
+            self._close(user_id, pending)
+        return await future
+
+    def stats(self) -> dict[str, int]:
+        return {"batches": self.batches, "coalesced": self.coalesced}
+
+    def _close(self, user_id: str, pending: _PendingWrites) -> None:
+        if self._pending.get(user_id) is pending:
+            del self._pending[user_id]
+        pending.full.set()
+
+    async def _flush_after_window(
+        self, user_id: str, pending: _PendingWrites, apply: ApplyOperations
+    ) -> None:
+        try:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(pending.full.wait(), self.window)
+            self._close(user_id, pending)
+            await self._flush(user_id, pending, apply)
+        finally:
+            for _, future in pending.requests:
+                future.cancel()
+
+    async def _flush(self, user_id: str, pending: _PendingWrites, apply: ApplyOperations) -> None:
+        requests = [operations for operations, _ in pending.requests]
+        futures = [future for _, future in pending.requests]
+        self.batches += 1
+        self.coalesced += len(requests)
+
+        try:
+            final = await apply(user_id, [op for operations in requests for op in operations])
+        except InsufficientBalanceError as e:
+            if len(requests) == 1:
+                _resolve(futures[0], e)
+            else:
+                await self._apply_one_by_one(user_id, requests, futures, apply)
+            return
+        except Exception as e:
+            for future in futures:
+                _resolve(future, e)
+            return
+
+        for index, future in enumerate(futures):
+            _resolve(future, _wallet_after(final, index, requests))
+
+    @staticmethod
+    async def _apply_one_by_one(
+        user_id: str,
+        requests: list[Operations],
+        futures: list[asyncio.Future[Wallet]],
+        apply: ApplyOperations,
+    ) -> None:
+        for operations, future in zip(requests, futures, strict=True):
+            try:
+                _resolve(future, await apply(user_id, operations))
+            except Exception as e:
+                _resolve(future, e)
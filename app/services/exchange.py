@@ -1,35 +1,351 @@
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import random
+import time
+from collections.abc import Callable
+from datetime import date
 from decimal import Decimal
+from typing import Any
 
 import httpx
-from fastapi_cache.decorator import cache
+from fastapi_cache import FastAPICache
 
 from app.config import get_settings
-from app.core.exceptions import ExchangeRateError
-from app.models.utils import quantize_decimal
+from app.core.circuit_breaker import CircuitBreaker, CircuitOpenError
+from app.core.exceptions import ExchangeRateError, InvalidCurrencyError, RatesNotAvailableError
+from app.core.invalidation import InvalidationBus
+from app.core.metrics import (
+    EXCHANGE_RATES_LOOKUP_DURATION,
+    NBP_REQUEST_DURATION,
+    record_cache_lookup,
+)
+from app.models.domain.rates import CrossRates, RatesSnapshot
+from app.models.schemas.rates import ConversionQuote, ConversionRequest, ConversionResponse
+from app.models.utils import get_current_time, quantize_decimal
+from app.repositories.rates import RateHistoryRepository
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+RATES_CACHE_KEY = "exchange_rates"
+
+
+def _parse_table(data: dict[str, Any]) -> RatesSnapshot:
+    return RatesSnapshot(
+        rates={rate["code"]: quantize_decimal(rate["ask"]) for rate in data["rates"]},
+        effective_date=data.get("effectiveDate"),
+        fetched_at=get_current_time(),
+    )
+
+
+def _is_retryable(error: httpx.HTTPError) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code == httpx.codes.TOO_MANY_REQUESTS or httpx.codes.is_server_error(
+            status_code
+        )
+    return True
 
 
 class ExchangeRateService:
-    def __init__(self):
+    def __init__(
+        self,
+        history: RateHistoryRepository | None = None,
+        invalidation: InvalidationBus | None = None,
+    ):
+        self.history = history
+        self.invalidation = invalidation
+        if invalidation is not None:
+            # another worker fetched a new table: pick it up from Redis now rather than when
+            # this worker's own refresh comes due
+            invalidation.register(RATES_CACHE_KEY, lambda _: self._reload(), self._reload)
         self.base_url = f"{settings.NBP_API_BASE_URL}/exchangerates/tables/C"
-        self.client = httpx.AsyncClient(timeout=10.0)
+        self.client = httpx.AsyncClient(
+            http2=settings.NBP_HTTP2,
+            timeout=httpx.Timeout(settings.NBP_READ_TIMEOUT, connect=settings.NBP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.NBP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.NBP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.NBP_KEEPALIVE_EXPIRY,
+            ),
+            headers={"Accept": "application/json"},
+        )
+        self._snapshot: RatesSnapshot | None = None
+        self._cross_rates: CrossRates | None = None
+        self._inflight: asyncio.Task[tuple[RatesSnapshot, str]] | None = None
+        self._refresh_task: asyncio.Task[None] | None = None
+        self._table_listeners: list[Callable[[RatesSnapshot], None]] = []
+        self.breaker = CircuitBreaker(
+            settings.NBP_CIRCUIT_FAILURE_THRESHOLD, settings.NBP_CIRCUIT_RESET_TIMEOUT
+        )
+
+    def start(self) -> None:
+        if self._refresh_task is None:
+            # started right away so requests arriving before the loop first runs join it
+            if self._inflight is None:
+                self._start_refresh()
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def warm(self) -> RatesSnapshot | None:
+        # Runs before the worker takes traffic, so the first requests after a deploy answer from
+        # the newest known table while start() refreshes it, instead of all waiting on NBP.
+        try:
+            snapshot = await asyncio.wait_for(
+                self._read_warm_snapshot(), settings.EXCHANGE_RATES_WARM_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Timed out loading a rates snapshot at startup")
+            return None
+        if snapshot is None:
+            return None
+
+        if snapshot.age >= settings.EXCHANGE_RATES_CACHE_TTL:
+            snapshot = dataclasses.replace(snapshot, stale=True)
+        self._set_snapshot(snapshot)
+        return snapshot
+
+    async def _read_warm_snapshot(self) -> RatesSnapshot | None:
+        snapshot = await self._read_shared_snapshot()
+        if snapshot is not None or self.history is None:
+            return snapshot
+        try:
+            return await self.history.get_latest()
+        except Exception:
+            logger.warning("Error reading the latest stored rates table", exc_info=True)
+            return None
 
     async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+            self._refresh_task = None
         await self.client.aclose()
 
-    @cache(expire=1800, key_builder=lambda *args, **kwargs: "exchange_rates")
+    def add_table_listener(self, listener: Callable[[RatesSnapshot], None]) -> None:
+        # called whenever valuations change: a new table, or a fallback table replaced or served
+        self._table_listeners.append(listener)
+
+    @property
+    def snapshot(self) -> RatesSnapshot | None:
+        return self._snapshot
+
+    @property
+    def rates_table(self) -> str:
+        # names the table valuations are made with right now; cached wallet responses are stored
+        # under it, so a new table, or a stale one served in its place, never gets an older body
+        snapshot = self._snapshot
+        if snapshot is None:
+            return "none"
+        return (
+            f"{snapshot.effective_date}:stale" if snapshot.stale else str(snapshot.effective_date)
+        )
+
     async def get_current_rates(self) -> dict[str, Decimal]:
+        snapshot = await self.get_snapshot()
+        return snapshot.rates
+
+    async def get_snapshot(self) -> RatesSnapshot:
+        started = time.perf_counter()
+        snapshot = self._snapshot
+        if snapshot is not None:
+            age = snapshot.age
+            if age < settings.EXCHANGE_RATES_CACHE_TTL:
+                EXCHANGE_RATES_LOOKUP_DURATION.labels("hit").observe(time.perf_counter() - started)
+                return snapshot
+            if age < settings.EXCHANGE_RATES_CACHE_TTL + settings.EXCHANGE_RATES_STALE_TTL:
+                # stale-while-revalidate: answer from memory, refresh behind the request
+                if self._inflight is None:
+                    self._start_refresh()
+                EXCHANGE_RATES_LOOKUP_DURATION.labels("stale").observe(
+                    time.perf_counter() - started
+                )
+                return snapshot
+            if snapshot.stale and (self._inflight is not None or self.breaker.state == "open"):
+                # a fallback or warm-start table: answer from it while NBP is being asked or
+                # known to be down
+                EXCHANGE_RATES_LOOKUP_DURATION.labels("fallback").observe(
+                    time.perf_counter() - started
+                )
+                return snapshot
+
+        snapshot, source = await self._refresh()
+        EXCHANGE_RATES_LOOKUP_DURATION.labels(source).observe(time.perf_counter() - started)
+        return snapshot
+
+    async def _refresh(self) -> tuple[RatesSnapshot, str]:
+        task = self._inflight or self._start_refresh()
+        return await asyncio.shield(task)
+
+    def _start_refresh(self) -> asyncio.Task[tuple[RatesSnapshot, str]]:
+        task = asyncio.create_task(self._load_snapshot())
+        task.add_done_callback(self._on_refresh_done)
+        self._inflight = task
+        return task
+
+    def _reload(self) -> None:
+        if self._inflight is None:
+            self._start_refresh()
+
+    def _on_refresh_done(self, task: asyncio.Task[tuple[RatesSnapshot, str]]) -> None:
+        self._inflight = None
+        if not task.cancelled() and (error := task.exception()) is not None:
+            logger.warning("Exchange rates refresh failed: %r", error)
+
+    async def _refresh_loop(self) -> None:
+        delay = 0.0
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                snapshot, _ = await self._refresh()
+            except ExchangeRateError:
+                delay = settings.EXCHANGE_RATES_RETRY_INTERVAL
+            else:
+                refresh_at = (
+                    settings.EXCHANGE_RATES_CACHE_TTL - settings.EXCHANGE_RATES_REFRESH_AHEAD
+                )
+                if snapshot.age >= refresh_at:
+                    # a fallback snapshot, NBP is retried as after a failure
+                    delay = settings.EXCHANGE_RATES_RETRY_INTERVAL
+                else:
+                    # jitter keeps workers from hitting NBP in lockstep
+                    delay = max(refresh_at - snapshot.age, 1.0) + random.uniform(
+                        0, settings.EXCHANGE_RATES_RETRY_INTERVAL
+                    )
+
+    async def _load_snapshot(self) -> tuple[RatesSnapshot, str]:
+        # also returns where the table came from: "redis", "upstream" or "fallback"
+        refresh_at = settings.EXCHANGE_RATES_CACHE_TTL - settings.EXCHANGE_RATES_REFRESH_AHEAD
+        shared = await self._read_shared_snapshot()
+        if shared is not None and shared.age < refresh_at:
+            self._set_snapshot(shared)
+            return shared, "redis"
+
         try:
-            response = await self.client.get(self.base_url, headers={"Accept": "application/json"})
-            response.raise_for_status()
+            snapshot = await self._fetch_rates()
+            source = "upstream"
+        except ExchangeRateError:
+            source = "fallback"
+            snapshot = await self._last_known_good(shared)
+            if snapshot is None:
+                raise
+            logger.warning(
+                "NBP unavailable, serving rates table %s fetched at %s",
+                snapshot.effective_date,
+                snapshot.fetched_at,
+            )
+        else:
+            await self._write_shared_snapshot(snapshot)
+            await self._record_history(snapshot)
+            if self.invalidation is not None:
+                await self.invalidation.publish(RATES_CACHE_KEY, [str(snapshot.effective_date)])
+        self._set_snapshot(snapshot)
+        return snapshot, source
 
-            data = response.json()[0]
-            return {rate["code"]: quantize_decimal(rate["ask"]) for rate in data["rates"]}
+    async def _last_known_good(self, shared: RatesSnapshot | None) -> RatesSnapshot | None:
+        candidates = [snapshot for snapshot in (shared, self._snapshot) if snapshot is not None]
+        if not candidates and self.history is not None:
+            try:
+                if latest := await self.history.get_latest():
+                    candidates.append(latest)
+            except Exception:
+                logger.warning("Error reading the latest stored rates table", exc_info=True)
+        if not candidates:
+            return None
+
+        snapshot = max(candidates, key=lambda candidate: candidate.fetched_at)
+        if snapshot.age < settings.EXCHANGE_RATES_CACHE_TTL:
+            return snapshot
+        return dataclasses.replace(snapshot, stale=True)
+
+    def _set_snapshot(self, snapshot: RatesSnapshot) -> None:
+        previous = self._snapshot
+        self._cross_rates = CrossRates.from_snapshot(snapshot)
+        self._snapshot = snapshot
+        if previous is not None and (previous.effective_date, previous.stale) != (
+            snapshot.effective_date,
+            snapshot.stale,
+        ):
+            for listener in self._table_listeners:
+                listener(snapshot)
+
+    async def _read_shared_snapshot(self) -> RatesSnapshot | None:
+        try:
+            cached = await FastAPICache.get_backend().get(RATES_CACHE_KEY)
+            record_cache_lookup(RATES_CACHE_KEY, cached is not None)
+            return RatesSnapshot.from_json(cached) if cached else None
+        except Exception:
+            logger.warning("Error reading exchange rates from cache", exc_info=True)
+            return None
+
+    async def _write_shared_snapshot(self, snapshot: RatesSnapshot) -> None:
+        try:
+            await FastAPICache.get_backend().set(
+                RATES_CACHE_KEY, snapshot.to_json(), expire=settings.EXCHANGE_RATES_CACHE_TTL
+            )
+        except Exception:
+            logger.warning("Error writing exchange rates to cache", exc_info=True)
+
+    async def _record_history(self, snapshot: RatesSnapshot) -> None:
+        if self.history is None or snapshot.effective_date is None:
+            return
+        try:
+            await self.history.save_table(snapshot)
+        except Exception:
+            logger.warning("Error recording rates table %s", snapshot.effective_date, exc_info=True)
+
+    async def get_rates_as_of(self, as_of: date) -> RatesSnapshot:
+        snapshot = await self.history.get_as_of(as_of) if self.history else None
+        if snapshot is None:
+            raise RatesNotAvailableError(as_of.isoformat())
+        return snapshot
+
+    async def fetch_tables(self, start: date, end: date) -> list[RatesSnapshot]:
+        data = await self._get_json(
+            f"{self.base_url}/{start.isoformat()}/{end.isoformat()}", allow_not_found=True
+        )
+        try:
+            return [_parse_table(table) for table in data or []]
+        except (KeyError, TypeError) as e:
+            raise ExchangeRateError() from e
 
-        except (httpx.HTTPError, IndexError, KeyError) as e:
+    async def _fetch_rates(self) -> RatesSnapshot:
+        data = await self._get_json(self.base_url)
+        try:
+            return _parse_table(data[0])
+        except (IndexError, KeyError, TypeError) as e:
             raise ExchangeRateError() from e
 
+    async def _get_json(self, url: str, allow_not_found: bool = False) -> Any:
+        # an open circuit fails at once instead of waiting on timeouts NBP keeps hitting
+        try:
+            with self.breaker:
+                return await self._get_json_with_retries(url, allow_not_found)
+        except CircuitOpenError as e:
+            raise ExchangeRateError() from e
+
+    async def _get_json_with_retries(self, url: str, allow_not_found: bool) -> Any:
+        for attempt in range(settings.NBP_MAX_RETRIES + 1):
+            try:
+                with NBP_REQUEST_DURATION.time():
+                    response = await self.client.get(url)
+                if allow_not_found and response.status_code == httpx.codes.NOT_FOUND:
+                    return None
+                response.raise_for_status()
+                return response.json()
+
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                if attempt == settings.NBP_MAX_RETRIES or not _is_retryable(e):
+                    raise ExchangeRateError() from e
+                await asyncio.sleep(settings.NBP_RETRY_BACKOFF * 2**attempt)
+
+            except httpx.HTTPError as e:
+                raise ExchangeRateError() from e
+
+        raise ExchangeRateError()
+
     async def convert_to_pln(self, currency: str, amount: Decimal) -> Decimal | None:
         if currency == "PLN":
             return amount
@@ -42,11 +358,48 @@ class ExchangeRateService:
 
         return quantize_decimal(amount * rate)
 
+    async def get_cross_rates(self) -> CrossRates:
+        snapshot = await self.get_snapshot()
+        cross_rates = self._cross_rates
+        if cross_rates is None or cross_rates.snapshot is not snapshot:
+            cross_rates = self._cross_rates = CrossRates.from_snapshot(snapshot)
+        return cross_rates
+
+    async def convert(self, conversions: list[ConversionRequest]) -> ConversionResponse:
+        cross_rates = await self.get_cross_rates()
+        quotes = []
+        for conversion in conversions:
+            rate = cross_rates.rate(conversion.from_currency, conversion.to_currency)
+            if rate is None:
+                unknown = conversion.from_currency
+                if unknown in cross_rates.matrix:
+                    unknown = conversion.to_currency
+                raise InvalidCurrencyError(unknown)
+            quotes.append(
+                ConversionQuote.model_construct(
+                    from_currency=conversion.from_currency,
+                    to_currency=conversion.to_currency,
+                    amount=conversion.amount,
+                    rate=rate,
+                    converted=quantize_decimal(conversion.amount * rate),
+                )
+            )
+        return ConversionResponse.model_construct(
+            quotes=quotes,
+            effective_date=cross_rates.snapshot.effective_date,
+            rates_stale=cross_rates.snapshot.stale,
+        )
+
     async def calculate_wallet_pln_values(self, balances: dict[str, Decimal]) -> dict[str, Decimal]:
         if not balances:
             return {}
 
-        rates = await self.get_current_rates()
+        return self.value_balances(balances, await self.get_current_rates())
+
+    @staticmethod
+    def value_balances(
+        balances: dict[str, Decimal], rates: dict[str, Decimal]
+    ) -> dict[str, Decimal]:
         pln_values = {}
 
         for currency, amount in balances.items():
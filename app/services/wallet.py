@@ -1,57 +1,215 @@
+import csv
+import hashlib
+import io
+import json
+from collections.abc import AsyncIterator
+from datetime import date
 from decimal import Decimal
+from typing import Literal
 
+from app.config import get_settings
 from app.core.exceptions import InsufficientFundsError, InvalidCurrencyError
+from app.models.domain.rates import RatesSnapshot
 from app.models.domain.wallet import Wallet
-from app.models.schemas.wallet import WalletOperation, WalletResponse
+from app.models.schemas.wallet import (
+    TransactionPage,
+    TransactionResponse,
+    ValuationHistory,
+    WalletBatchItem,
+    WalletOperation,
+    WalletResponse,
+)
 from app.models.utils import quantize_decimal
-from app.repositories.wallet import WalletRepository
+from app.repositories.valuations import ValuationRepository
+from app.repositories.wallet import InsufficientBalanceError, WalletRepository
+from app.services.coalescer import WriteCoalescer
 from app.services.exchange import ExchangeRateService
+from app.services.wallet_events import WalletEventHub
+
+settings = get_settings()
+
+ExportFormat = Literal["ndjson", "csv"]
+
+
+def wallet_etag(wallet: Wallet, snapshot: RatesSnapshot | None) -> str:
+    # The body is a function of the balances and the rates table, so this changes exactly when
+    # the body does. Balances are included because coalesced writes share one updated_at.
+    effective_date = snapshot.effective_date if snapshot else None
+    rates_stale = snapshot.stale if snapshot else False
+    parts = [
+        wallet.updated_at.isoformat(),
+        str(effective_date),
+        str(rates_stale),
+        *(f"{currency}={amount}" for currency, amount in sorted(wallet.balances.items())),
+    ]
+    return f'"{hashlib.blake2b("|".join(parts).encode(), digest_size=12).hexdigest()}"'
 
 
 class WalletService:
-    def __init__(self, wallet_repository: WalletRepository, exchange_service: ExchangeRateService):
+    def __init__(  # noqa: PLR0913
+        self,
+        wallet_repository: WalletRepository,
+        exchange_service: ExchangeRateService,
+        valuation_repository: ValuationRepository | None = None,
+        write_coalescer: WriteCoalescer | None = None,
+        wallet_events: WalletEventHub | None = None,
+    ):
         self.wallet_repository = wallet_repository
         self.exchange_service = exchange_service
+        self.valuation_repository = valuation_repository
+        self.write_coalescer = write_coalescer
+        self.wallet_events = wallet_events
+
+    @property
+    def rates_table(self) -> str:
+        return self.exchange_service.rates_table
 
     async def get_wallet(self, user_id: str) -> WalletResponse:
+        return await self._build_response(await self.load_wallet(user_id))
+
+    async def load_wallet(self, user_id: str) -> Wallet:
         wallet = await self.wallet_repository.get_wallet(user_id)
         if not wallet:
             wallet = await self._create_wallet(user_id)
+        return wallet
 
-        pln_values = await self.exchange_service.calculate_wallet_pln_values(wallet.balances)
+    async def value_wallet(self, wallet: Wallet) -> WalletResponse:
+        # values a wallet loaded earlier against the current rates table, without reading it again
+        return await self._build_response(wallet)
 
-        total_pln = quantize_decimal(sum(pln_values.values(), Decimal("0")))
+    async def get_wallet_as_of(self, user_id: str, as_of: date) -> WalletResponse:
+        snapshot = await self.exchange_service.get_rates_as_of(as_of)
 
-        return WalletResponse(balances=wallet.balances, pln_values=pln_values, total_pln=total_pln)
+        wallet = await self.wallet_repository.get_wallet(user_id)
+        if not wallet:
+            wallet = await self._create_wallet(user_id)
+
+        pln_values = self.exchange_service.value_balances(wallet.balances, snapshot.rates)
+        return self._assemble_response(wallet, pln_values, snapshot)
 
     async def add_funds(self, user_id: str, operation: WalletOperation) -> WalletResponse:
         await self._validate_currency(operation.currency)
 
-        await self.wallet_repository.update_balance(
-            user_id=user_id,
-            currency=operation.currency,
-            amount=operation.amount,
-        )
+        wallet = await self._apply_operations(user_id, [(operation.currency, operation.amount)])
 
-        return await self.get_wallet(user_id)
+        return await self._build_response(wallet)
 
     async def subtract_funds(self, user_id: str, operation: WalletOperation) -> WalletResponse:
         await self._validate_currency(operation.currency)
 
         try:
-            await self.wallet_repository.update_balance(
-                user_id=user_id,
-                currency=operation.currency,
-                amount=operation.amount,
-                subtract=True,
+            wallet = await self._apply_operations(
+                user_id, [(operation.currency, -operation.amount)]
             )
-        except ValueError as e:
+        except InsufficientBalanceError as e:
             raise InsufficientFundsError(operation.currency) from e
 
-        return await self.get_wallet(user_id)
+        return await self._build_response(wallet)
+
+    async def apply_batch(self, user_id: str, operations: list[WalletBatchItem]) -> WalletResponse:
+        await self._validate_currencies({operation.currency for operation in operations})
+
+        try:
+            wallet = await self._apply_operations(
+                user_id,
+                [
+                    (
+                        operation.currency,
+                        operation.amount if operation.operation == "add" else -operation.amount,
+                    )
+                    for operation in operations
+                ],
+            )
+        except InsufficientBalanceError as e:
+            raise InsufficientFundsError(e.currency) from e
+
+        return await self._build_response(wallet)
+
+    async def list_transactions(
+        self, user_id: str, limit: int, before: int | None = None
+    ) -> TransactionPage:
+        ledger = self.wallet_repository.ledger
+        entries = []
+        if ledger:
+            await self.wallet_repository.flush_pending_ledger(user_id)
+            entries = await ledger.list_entries(user_id, limit, before)
+
+        return TransactionPage(
+            items=[TransactionResponse.model_validate(entry.model_dump()) for entry in entries],
+            next_before=entries[-1].seq if len(entries) == limit else None,
+        )
+
+    async def get_valuation_history(self, user_id: str, start: date, end: date) -> ValuationHistory:
+        if self.valuation_repository is None or end < start:
+            return ValuationHistory(points=[])
+        return ValuationHistory(
+            points=await self.valuation_repository.get_series(user_id, start, end)
+        )
+
+    async def export_valuations(
+        self, rates: dict[str, Decimal], export_format: ExportFormat
+    ) -> AsyncIterator[str]:
+        if export_format == "csv":
+            yield "user_id,currency,amount,pln_value\r\n"
+
+        async for wallets in self.wallet_repository.iter_wallets(settings.EXPORT_BATCH_SIZE):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for wallet in wallets:
+                pln_values = self.exchange_service.value_balances(wallet.balances, rates)
+                if export_format == "csv":
+                    writer.writerows(
+                        (wallet.user_id, currency, amount, pln_values.get(currency, ""))
+                        for currency, amount in wallet.balances.items()
+                    )
+                    continue
+                line = {
+                    "user_id": wallet.user_id,
+                    "balances": {c: str(a) for c, a in wallet.balances.items()},
+                    "pln_values": {c: str(v) for c, v in pln_values.items()},
+                    "total_pln": str(quantize_decimal(sum(pln_values.values(), Decimal("0")))),
+                }
+                buffer.write(json.dumps(line) + "\n")
+            yield buffer.getvalue()
+
+    async def _apply_operations(
+        self, user_id: str, operations: list[tuple[str, Decimal]]
+    ) -> Wallet:
+        if self.write_coalescer is None:
+            wallet = await self.wallet_repository.apply_operations(user_id, operations)
+        else:
+            wallet = await self.write_coalescer.submit(
+                user_id, operations, self.wallet_repository.apply_operations
+            )
+        if self.wallet_events is not None:
+            await self.wallet_events.publish(user_id)
+        return wallet
+
+    async def _build_response(self, wallet: Wallet) -> WalletResponse:
+        if not wallet.balances:
+            return self._assemble_response(wallet, {})
+
+        snapshot = await self.exchange_service.get_snapshot()
+        pln_values = self.exchange_service.value_balances(wallet.balances, snapshot.rates)
+        return self._assemble_response(wallet, pln_values, snapshot)
+
+    @staticmethod
+    def _assemble_response(
+        wallet: Wallet, pln_values: dict[str, Decimal], snapshot: RatesSnapshot | None = None
+    ) -> WalletResponse:
+        # balances come from minor units and pln_values are quantized by value_balances, so
+        # the WalletResponse validators would only quantize them a second time
+        response = WalletResponse.model_construct(
+            balances=wallet.balances,
+            pln_values=pln_values,
+            total_pln=quantize_decimal(sum(pln_values.values(), Decimal("0"))),
+            rates_stale=snapshot.stale if snapshot else False,
+        )
+        response._etag = wallet_etag(wallet, snapshot)
+        response._version = wallet.version
+        return response
 
     async def _create_wallet(self, user_id: str) -> Wallet:
-        wallet = Wallet(user_id=user_id)
         wallet = await self.wallet_repository.update_balance(
             user_id=user_id,
             currency="PLN",
@@ -60,9 +218,14 @@ class WalletService:
         return wallet
 
     async def _validate_currency(self, currency: str) -> None:
-        if currency == "PLN":
+        await self._validate_currencies({currency})
+
+    async def _validate_currencies(self, currencies: set[str]) -> None:
+        currencies = currencies - {"PLN"}
+        if not currencies:
             return
 
         rates = await self.exchange_service.get_current_rates()
-        if currency not in rates:
-            raise InvalidCurrencyError(currency)
+        for currency in sorted(currencies):
+            if currency not in rates:
+                raise InvalidCurrencyError(currency)
@@ -0,0 +1,131 @@
+import asyncio
+import contextlib
+import logging
+import random
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from dataclasses import dataclass, field
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+WALLET_EVENTS_CHANNEL = "wallet_events"
+
+# returns the wallet's current (etag, encoded body); the flag is False when only the rates table
+# changed, so the balances loaded last time can be valued again without reading them
+LoadValuation = Callable[[bool], Awaitable[tuple[str, bytes]]]
+
+
+# compared and hashed by identity, one per open stream
+@dataclass(eq=False)
+class _Subscription:
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    reload: bool = True
+
+
+# Pushes wallet valuations to streaming clients. Every worker keeps one Redis pub/sub connection
+# and wakes the local streams of the users named on the channel, so a mutation handled by any
+# worker reaches subscribers on all of them. A new rates table is noticed by each worker's own
+# ExchangeRateService and wakes every local stream, spread over notify_spread seconds so the
+# streams do not all value their wallets in the same instant.
+class WalletEventHub:
+    def __init__(
+        self, redis: Redis, keepalive: float, reconnect_delay: float, notify_spread: float = 0.0
+    ):
+        self.redis = redis
+        self.keepalive = keepalive
+        self.reconnect_delay = reconnect_delay
+        self.notify_spread = notify_spread
+        # an idle stream costs one _Subscription here, its generator frame and the socket
+        self._subscriptions: dict[str, set[_Subscription]] = {}
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "users": len(self._subscriptions),
+            "streams": sum(len(subscriptions) for subscriptions in self._subscriptions.values()),
+        }
+
+    async def publish(self, user_id: str) -> None:
+        try:
+            await self.redis.publish(WALLET_EVENTS_CHANNEL, user_id)
+        except RedisError:
+            logger.warning("Error publishing wallet event for %s", user_id, exc_info=True)
+
+    def notify(self, user_id: str) -> None:
+        for subscription in self._subscriptions.get(user_id, ()):
+            self._wake(subscription, reload=True)
+
+    def notify_all(self, reload: bool = True) -> None:
+        # reload=False for a new rates table: the balances each stream holds are still current
+        loop = asyncio.get_running_loop()
+        for subscriptions in self._subscriptions.values():
+            for subscription in subscriptions:
+                if self.notify_spread > 0:
+                    delay = random.uniform(0, self.notify_spread)
+                    loop.call_later(delay, self._wake, subscription, reload)
+                else:
+                    self._wake(subscription, reload)
+
+    @staticmethod
+    def _wake(subscription: _Subscription, reload: bool) -> None:
+        subscription.reload = subscription.reload or reload
+        subscription.changed.set()
+
+    @contextlib.contextmanager
+    def subscribe(self, user_id: str) -> Iterator[_Subscription]:
+        subscription = _Subscription()
+        self._subscriptions.setdefault(user_id, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscriptions = self._subscriptions[user_id]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[user_id]
+
+    async def stream(self, user_id: str, load: LoadValuation) -> AsyncIterator[bytes]:
+        with self.subscribe(user_id) as subscription:
+            changed = subscription.changed
+            last_etag = None
+            while True:
+                # cleared before loading, so a change made while loading is not missed
+                changed.clear()
+                reload, subscription.reload = subscription.reload, False
+                etag, body = await load(reload)
+                # a wake-up that changed nothing, e.g. after a reconnect, sends nothing
+                if etag != last_etag:
+                    last_etag = etag
+                    yield b"event: valuation\nid: %s\ndata: %s\n\n" % (etag.encode(), body)
+
+                while not changed.is_set():
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(changed.wait(), self.keepalive)
+                    if not changed.is_set():
+                        # keeps proxies from closing an idle connection
+                        yield b": keepalive\n\n"
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(WALLET_EVENTS_CHANNEL)
+                    # events published while disconnected are lost, so every stream rechecks
+                    self.notify_all()
+                    async for message in pubsub.listen():
+                        self.notify(message["data"].decode())
+            except RedisError:
+                logger.warning("Wallet events subscription lost, reconnecting", exc_info=True)
+                await asyncio.sleep(self.reconnect_delay)
@@ -0,0 +1,211 @@
+"""Load test of the API hot paths against in-process stand-ins for MongoDB, Redis and NBP.
+
+Every scenario drives the ASGI app with concurrent virtual users for a fixed time and reports
+throughput and latency percentiles per endpoint as JSON. With --baseline, the run is compared
+against a saved report and exits with status 1 when a scenario regressed beyond --tolerance.
+
+Usage: python -m benchmarks.load [--users N] [--duration SECONDS] [--scenarios a,b]
+                                 [--output FILE] [--baseline FILE] [--tolerance RATIO]
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from typing import Any
+from unittest.mock import patch
+
+import httpx
+from asgi_lifespan import LifespanManager
+from fakeredis.aioredis import FakeRedis
+from mongomock_motor import AsyncMongoMockClient
+
+# limits would throttle the virtual users long before the app itself saturates
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+NBP_TABLE = [
+    {
+        "effectiveDate": "2024-01-02",
+        "rates": [
+            {"code": "EUR", "ask": 4.50},
+            {"code": "USD", "ask": 4.00},
+            {"code": "GBP", "ask": 5.20},
+        ],
+    }
+]
+PASSWORD = "benchmark-password"
+
+Request = Callable[[httpx.AsyncClient, dict[str, Any]], Awaitable[httpx.Response]]
+
+
+def _nbp_handler(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(httpx.codes.OK, json=NBP_TABLE)
+
+
+async def _get_wallet(client: httpx.AsyncClient, user: dict[str, Any]) -> httpx.Response:
+    return await client.get("/api/v1/wallet", headers=user["headers"])
+
+
+async def _add_funds(client: httpx.AsyncClient, user: dict[str, Any]) -> httpx.Response:
+    return await client.post(
+        "/api/v1/wallet/add",
+        json={"currency": "EUR", "amount": "1.00"},
+        headers=user["headers"],
+    )
+
+
+async def _login(client: httpx.AsyncClient, user: dict[str, Any]) -> httpx.Response:
+    return await client.post(
+        "/api/v1/auth/token", json={"email": user["email"], "password": PASSWORD}
+    )
+
+
+SCENARIOS: dict[str, Request] = {
+    "wallet_get": _get_wallet,
+    "wallet_add": _add_funds,
+    "auth_token": _login,
+}
+
+
+def _percentile(cuts: list[float], p: int) -> float:
+    return round(cuts[p - 1] * 1000, 2)
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict[str, Any]:
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": _percentile(cuts, 50),
+        "p95_ms": _percentile(cuts, 95),
+        "p99_ms": _percentile(cuts, 99),
+    }
+
+
+async def _virtual_user(
+    client: httpx.AsyncClient,
+    request: Request,
+    user: dict[str, Any],
+    deadline: float,
+    latencies: list[float],
+) -> int:
+    errors = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        response = await request(client, user)
+        latencies.append(time.perf_counter() - started)
+        if response.is_error:
+            errors += 1
+    return errors
+
+
+async def run_scenario(
+    client: httpx.AsyncClient, request: Request, users: list[dict[str, Any]], duration: float
+) -> dict[str, Any]:
+    latencies: list[float] = []
+    started = time.perf_counter()
+    errors = await asyncio.gather(
+        *(_virtual_user(client, request, user, started + duration, latencies) for user in users)
+    )
+    return summarize(latencies, sum(errors), time.perf_counter() - started)
+
+
+async def _register(client: httpx.AsyncClient) -> dict[str, Any]:
+    email = f"bench_{uuid.uuid4().hex}@example.com"
+    response = await client.post(
+        "/api/v1/auth/register", json={"email": email, "password": PASSWORD}
+    )
+    response.raise_for_status()
+    return {
+        "email": email,
+        "headers": {"Authorization": f"Bearer {response.json()['access_token']}"},
+    }
+
+
+async def run(users: int, duration: float, scenarios: list[str]) -> dict[str, Any]:
+    mongo = AsyncMongoMockClient()
+    redis = FakeRedis()
+    nbp_client = functools.partial(httpx.AsyncClient, transport=httpx.MockTransport(_nbp_handler))
+    with (
+        patch("motor.motor_asyncio.AsyncIOMotorClient", lambda *args, **kwargs: mongo),
+        patch("redis.asyncio.from_url", lambda *args, **kwargs: redis),
+        patch("app.services.exchange.httpx.AsyncClient", nbp_client),
+    ):
+        from app.main import create_application
+
+        app = create_application()
+        async with (
+            LifespanManager(app),
+            httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app), base_url="http://benchmark"
+            ) as client,
+        ):
+            virtual_users = await asyncio.gather(*(_register(client) for _ in range(users)))
+            # warm the rates and wallet caches so every scenario measures steady state
+            await asyncio.gather(*(_get_wallet(client, user) for user in virtual_users))
+
+            results = {}
+            for name in scenarios:
+                results[name] = await run_scenario(client, SCENARIOS[name], virtual_users, duration)
+
+    return {"users": users, "duration": duration, "scenarios": results}
+
+
+def compare(report: dict[str, Any], baseline: dict[str, Any], tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in report["scenarios"].items():
+        if (previous := baseline["scenarios"].get(name)) is None:
+            continue
+        if result["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: rps {previous['rps']} -> {result['rps']}")
+        for key in ("p95_ms", "p99_ms"):
+            if result[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {previous[key]} -> {result[key]}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(",")
+    if unknown := set(scenarios) - SCENARIOS.keys():
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = asyncio.run(run(args.users, args.duration, scenarios))
+
+    baseline_missing = args.baseline is not None and not args.baseline.exists()
+    if args.baseline and not baseline_missing:
+        regressions = compare(report, json.loads(args.baseline.read_text()), args.tolerance)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2)
+    if baseline_missing:
+        # the first run on a machine has nothing to compare with and becomes its baseline
+        args.baseline.write_text(output + "\n")
+        print(f"No baseline at {args.baseline}, saved this run as the baseline", file=sys.stderr)
+
+    if args.output:
+        args.output.write_text(output + "\n")
+    print(output)
+
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Per-request CPU cost of building and encoding a wallet response.
+
+"validated" repeats what the endpoint did before: the WalletResponse validators, then FastAPI's
+response_model round-trip (dump, validate again, dump to JSON-able data) and stdlib json.
+"fast" is the current path: model_construct from quantized values and orjson.
+
+Usage: python -m benchmarks.wallet_response [--iterations N] [--currencies N]
+"""
+
+import argparse
+import json
+import timeit
+from decimal import Decimal
+
+from app.core.responses import encode_model
+from app.models.domain.wallet import Wallet
+from app.models.schemas.wallet import WalletResponse
+from app.models.utils import from_minor_units
+from app.services.exchange import ExchangeRateService
+from app.services.wallet import WalletService
+
+CURRENCIES = ["EUR", "USD", "GBP", "CHF", "JPY", "CZK", "SEK", "NOK", "DKK", "HUF", "CAD", "AUD"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--currencies", type=int, default=4, choices=range(1, 13))
+    args = parser.parse_args()
+
+    codes = CURRENCIES[: args.currencies]
+    balances = {code: from_minor_units(123456 + i) for i, code in enumerate(codes)}
+    rates = {code: Decimal("4.1234") for code in codes}
+    wallet = Wallet.model_construct(user_id="benchmark-user", balances=balances)
+
+    def validated() -> bytes:
+        pln_values = ExchangeRateService.value_balances(wallet.balances, rates)
+        response = WalletResponse(
+            balances=Wallet(user_id=wallet.user_id, balances=wallet.balances).balances,
+            pln_values=pln_values,
+            total_pln=sum(pln_values.values(), Decimal("0")),
+        )
+        content = WalletResponse.model_validate(response.model_dump()).model_dump(mode="json")
+        return json.dumps(content, separators=(",", ":")).encode()
+
+    def fast() -> bytes:
+        pln_values = ExchangeRateService.value_balances(wallet.balances, rates)
+        return encode_model(WalletService._assemble_response(wallet, pln_values))
+
+    assert json.loads(validated()) == json.loads(fast())
+
+    validated_s = timeit.timeit(validated, number=args.iterations) / args.iterations
+    fast_s = timeit.timeit(fast, number=args.iterations) / args.iterations
+
+    print(
+        json.dumps(
+            {
+                "iterations": args.iterations,
+                "currencies": args.currencies,
+                "validated_us": round(validated_s * 1e6, 2),
+                "fast_us": round(fast_s * 1e6, 2),
+                "saved_us_per_request": round((validated_s - fast_s) * 1e6, 2),
+                "speedup": round(validated_s / fast_s, 1),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,10 @@
 set -e
 
 # Run code formatting
-poetry run black app tests
+poetry run black app tests benchmarks
 
 # Run linting
-poetry run ruff app tests
+poetry run ruff app tests benchmarks
 
 # Run type checking
 poetry run mypy app tests
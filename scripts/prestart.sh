@@ -20,5 +20,9 @@ echo "Creating MongoDB indexes..."
 mongosh mongodb:27017/wallet_app --eval '
     db.wallets.createIndex({"user_id": 1}, {unique: true});
     db.users.createIndex({"email": 1}, {unique: true});
+    db.wallet_ledger.createIndex({"user_id": 1, "seq": 1}, {unique: true});
+    db.wallet_snapshots.createIndex({"user_id": 1, "seq": 1}, {unique: true});
+    db.wallet_valuations.createIndex({"user_id": 1, "date": 1}, {unique: true});
+    db.exchange_rate_tables.createIndex({"effective_date": 1}, {unique: true});
 '
 echo "Indexes created!"
@@ -4,6 +4,7 @@ from collections.abc import AsyncGenerator
 from unittest.mock import AsyncMock, Mock, patch
 
 import pytest
+from asgi_lifespan import LifespanManager
 from fakeredis.aioredis import FakeRedis
 from fastapi import FastAPI, status
 from fastapi_cache import FastAPICache
@@ -18,7 +19,7 @@ pytest.MonkeyPatch().setattr(
 
 MOCK_REDIS = FakeRedis()
 
-pytest.MonkeyPatch().setattr("redis.asyncio", lambda *args, **kwargs: MOCK_REDIS, raising=False)
+pytest.MonkeyPatch().setattr("redis.asyncio.from_url", lambda *args, **kwargs: MOCK_REDIS)
 
 from fastapi_cache.backends.redis import RedisBackend  # noqa: E402
 
@@ -44,6 +45,7 @@ async def mock_db_client() -> AsyncGenerator[AsyncMongoMockClient, None]:
 
     await db.users.create_index("email", unique=True)
     await db.wallets.create_index("user_id", unique=True)
+    await db.wallet_ledger.create_index([("user_id", 1), ("seq", 1)], unique=True)
 
     yield client
 
@@ -55,8 +57,10 @@ async def app() -> AsyncGenerator[FastAPI, None]:
         return_value=get_mock_exchange_rates_httpx_client(),
     ):
         app = create_application()
-        FastAPICache.init(RedisBackend(MOCK_REDIS), prefix="fastapi-cache")
-        yield app
+        async with LifespanManager(app):
+            FastAPICache.init(RedisBackend(MOCK_REDIS), prefix="fastapi-cache")
+            await app.state.redis.flushall()
+            yield app
 
 
 @pytest.fixture
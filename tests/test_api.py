@@ -1,7 +1,17 @@
+import json
+from decimal import Decimal
+
 import pytest
-from fastapi import status
+from fastapi import FastAPI, status
 from httpx import AsyncClient
+from mongomock_motor import AsyncMongoMockClient
 
+from app.core.cache import cache_wallet, get_cached_wallet, get_cached_wallet_etag
+from app.core.rate_limit import RateLimit
+from app.core.security import create_access_token, verify_token
+from app.models.domain.rates import RatesSnapshot
+from app.models.utils import get_current_time
+from app.repositories.rates import RateHistoryRepository
 from tests.conftest import generate_user_data
 
 pytestmark = pytest.mark.asyncio
@@ -25,6 +35,36 @@ class TestAuthAPI:
         assert response.status_code == status.HTTP_200_OK
         assert "access_token" in response.json()
 
+    async def test_login_is_rate_limited(
+        self, app: FastAPI, client: AsyncClient, test_user: dict
+    ) -> None:
+        limit = RateLimit(capacity=2, period=60)
+        app.state.rate_limiter.limits["auth"] = limit
+        credentials = {"email": test_user["email"], "password": test_user["password"]}
+
+        responses = [
+            await client.post("/api/v1/auth/token", json=credentials)
+            for _ in range(limit.capacity + 1)
+        ]
+
+        assert [r.status_code for r in responses[:-1]] == [status.HTTP_200_OK] * limit.capacity
+        assert responses[-1].status_code == status.HTTP_429_TOO_MANY_REQUESTS
+        assert responses[-1].json()["code"] == "RATE_LIMITED"
+        assert int(responses[-1].headers["Retry-After"]) > 0
+
+    async def test_users_behind_one_address_have_separate_buckets(
+        self, app: FastAPI, client: AsyncClient
+    ) -> None:
+        app.state.rate_limiter.limits["wallet_read"] = RateLimit(capacity=1, period=60)
+        tokens = [create_access_token({"sub": user_id}) for user_id in ("user-a", "user-b")]
+
+        responses = [
+            await client.get("/api/v1/wallet", headers={"Authorization": f"Bearer {token}"})
+            for token in tokens
+        ]
+
+        assert [r.status_code for r in responses] == [status.HTTP_200_OK] * 2
+
 
 class TestWalletAPI:
     async def test_get_wallet(self, authorized_client: AsyncClient) -> None:
@@ -43,6 +83,131 @@ class TestWalletAPI:
         data = response.json()
         assert data["balances"]["EUR"] == "100.00"
 
+    async def test_mutation_writes_through_cache(
+        self, app: FastAPI, authorized_client: AsyncClient
+    ) -> None:
+        token = authorized_client.headers["Authorization"].removeprefix("Bearer ")
+        user_id = verify_token(token)["sub"]
+        await authorized_client.get("/api/v1/wallet")
+
+        await authorized_client.post(
+            "/api/v1/wallet/add", json={"currency": "GBP", "amount": "12.50"}
+        )
+
+        cached = await get_cached_wallet(user_id, app.state.exchange_service.rates_table)
+        assert cached is not None
+        etag, body = cached
+        assert json.loads(body)["balances"]["GBP"] == "12.50"
+        response = await authorized_client.get("/api/v1/wallet")
+        assert response.json()["balances"]["GBP"] == "12.50"
+        assert response.headers["ETag"] == etag
+
+    async def test_older_response_does_not_overwrite_cache(
+        self, app: FastAPI, authorized_client: AsyncClient
+    ) -> None:
+        token = authorized_client.headers["Authorization"].removeprefix("Bearer ")
+        user_id = verify_token(token)["sub"]
+        for amount in ("12.50", "1.00"):
+            await authorized_client.post(
+                "/api/v1/wallet/add", json={"currency": "GBP", "amount": amount}
+            )
+        table = app.state.exchange_service.rates_table
+        etag, body = await get_cached_wallet(user_id, table)
+
+        # the response of the first write, finishing last
+        await cache_wallet(user_id, table, b'{"balances":{}}', '"older"', 1)
+
+        assert await get_cached_wallet(user_id, table) == (etag, body)
+        assert await get_cached_wallet_etag(user_id, table) == etag
+
+    async def test_new_rates_table_is_not_answered_from_cache(
+        self, app: FastAPI, authorized_client: AsyncClient
+    ) -> None:
+        await authorized_client.post(
+            "/api/v1/wallet/add", json={"currency": "EUR", "amount": "10.00"}
+        )
+        first = await authorized_client.get("/api/v1/wallet")
+        etag = first.headers["ETag"]
+
+        app.state.exchange_service._set_snapshot(
+            RatesSnapshot({"EUR": Decimal("5.00")}, "2099-01-02", get_current_time())
+        )
+        response = await authorized_client.get("/api/v1/wallet", headers={"If-None-Match": etag})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["ETag"] != etag
+        assert response.json()["pln_values"]["EUR"] == "50.00"
+
+    async def test_conditional_get(
+        self, authorized_client: AsyncClient, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        first = await authorized_client.get("/api/v1/wallet")
+        etag = first.headers["ETag"]
+
+        # answered from the ETag key alone, the cached body is not read
+        monkeypatch.setattr("app.api.v1.endpoints.wallet.get_cached_wallet", None)
+        response = await authorized_client.get("/api/v1/wallet", headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert response.headers["ETag"] == etag
+        assert not response.content
+        monkeypatch.undo()
+
+        await authorized_client.post(
+            "/api/v1/wallet/add", json={"currency": "EUR", "amount": "1.00"}
+        )
+        response = await authorized_client.get("/api/v1/wallet", headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["ETag"] != etag
+        assert response.json()["balances"]["EUR"] == "1.00"
+
+    async def test_get_wallet_as_of(
+        self, authorized_client: AsyncClient, mock_db_client: AsyncMongoMockClient
+    ) -> None:
+        history = RateHistoryRepository(mock_db_client.wallet_app.exchange_rate_tables)
+        await history.save_table(
+            RatesSnapshot({"EUR": Decimal("4.00")}, "2020-03-02", get_current_time())
+        )
+        await authorized_client.post(
+            "/api/v1/wallet/add", json={"currency": "EUR", "amount": "10.00"}
+        )
+
+        response = await authorized_client.get("/api/v1/wallet", params={"as_of": "2020-03-04"})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["pln_values"]["EUR"] == "40.00"
+
+        response = await authorized_client.get("/api/v1/wallet", params={"as_of": "1990-01-01"})
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        assert response.json()["code"] == "RATES_NOT_AVAILABLE"
+
+    async def test_valuation_history(self, authorized_client: AsyncClient) -> None:
+        response = await authorized_client.get(
+            "/api/v1/wallet/history", params={"from": "2024-01-01", "to": "2024-01-31"}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {"points": []}
+
+        response = await authorized_client.get("/api/v1/wallet/history")
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    async def test_transactions_keyset_pagination(self, authorized_client: AsyncClient) -> None:
+        for amount in ("1.00", "2.00", "3.00"):
+            await authorized_client.post(
+                "/api/v1/wallet/add", json={"currency": "USD", "amount": amount}
+            )
+
+        first = (await authorized_client.get("/api/v1/wallet/transactions?limit=2")).json()
+        assert [item["amount"] for item in first["items"]] == ["3.00", "2.00"]
+        assert first["next_before"] is not None
+
+        second = (
+            await authorized_client.get(
+                "/api/v1/wallet/transactions",
+                params={"limit": 2, "before": first["next_before"]},
+            )
+        ).json()
+        assert [item["amount"] for item in second["items"]] == ["1.00"]
+        assert second["next_before"] is None
+
     async def test_subtract_funds(self, authorized_client: AsyncClient) -> None:
         # First add funds
         await authorized_client.post(
@@ -86,3 +251,167 @@ class TestWalletAPI:
             "/api/v1/wallet/add", json={"currency": "EUR", "amount": amount}
         )
         assert response.status_code == expected_status
+
+    async def test_batch_operations(self, authorized_client: AsyncClient) -> None:
+        response = await authorized_client.post(
+            "/api/v1/wallet/batch",
+            json={
+                "operations": [
+                    {"operation": "add", "currency": "EUR", "amount": "100.00"},
+                    {"operation": "add", "currency": "USD", "amount": "40.00"},
+                    {"operation": "subtract", "currency": "EUR", "amount": "25.00"},
+                ]
+            },
+        )
+        assert response.status_code == status.HTTP_200_OK
+        data = response.json()
+        assert data["balances"]["EUR"] == "75.00"
+        assert data["balances"]["USD"] == "40.00"
+
+    async def test_batch_is_all_or_nothing(self, authorized_client: AsyncClient) -> None:
+        await authorized_client.post(
+            "/api/v1/wallet/add", json={"currency": "GBP", "amount": "10.00"}
+        )
+
+        response = await authorized_client.post(
+            "/api/v1/wallet/batch",
+            json={
+                "operations": [
+                    {"operation": "add", "currency": "EUR", "amount": "100.00"},
+                    {"operation": "subtract", "currency": "GBP", "amount": "20.00"},
+                ]
+            },
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()["code"] == "INSUFFICIENT_FUNDS"
+
+        wallet = (await authorized_client.get("/api/v1/wallet")).json()
+        assert "EUR" not in wallet["balances"]
+        assert wallet["balances"]["GBP"] == "10.00"
+
+    async def test_idempotent_retry_replays_first_response(
+        self, authorized_client: AsyncClient
+    ) -> None:
+        headers = {"Idempotency-Key": "retry-1"}
+        operation = {"currency": "EUR", "amount": "30.00"}
+
+        first = await authorized_client.post("/api/v1/wallet/add", json=operation, headers=headers)
+        retry = await authorized_client.post("/api/v1/wallet/add", json=operation, headers=headers)
+
+        assert retry.status_code == status.HTTP_200_OK
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        assert retry.content == first.content
+        wallet = (await authorized_client.get("/api/v1/wallet")).json()
+        assert wallet["balances"]["EUR"] == "30.00"
+
+    async def test_idempotency_key_reused_for_other_request(
+        self, authorized_client: AsyncClient
+    ) -> None:
+        headers = {"Idempotency-Key": "retry-2"}
+        await authorized_client.post(
+            "/api/v1/wallet/add", json={"currency": "EUR", "amount": "1.00"}, headers=headers
+        )
+
+        response = await authorized_client.post(
+            "/api/v1/wallet/add", json={"currency": "EUR", "amount": "2.00"}, headers=headers
+        )
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+        assert response.json()["code"] == "IDEMPOTENCY_KEY_REUSED"
+
+
+class TestRatesAPI:
+    async def test_convert(self, authorized_client: AsyncClient) -> None:
+        response = await authorized_client.get(
+            "/api/v1/rates/convert", params={"from": "EUR", "to": "USD", "amount": "100"}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        quote = response.json()["quotes"][0]
+        assert quote["from"] == "EUR"
+        assert quote["to"] == "USD"
+        assert quote["converted"] == "112.50"
+
+        response = await authorized_client.get(
+            "/api/v1/rates/convert", params={"from": "EUR", "to": "XXX", "amount": "1"}
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()["code"] == "INVALID_CURRENCY"
+
+    async def test_convert_batch(self, authorized_client: AsyncClient) -> None:
+        response = await authorized_client.post(
+            "/api/v1/rates/convert/batch",
+            json={
+                "conversions": [
+                    {"from": "GBP", "to": "PLN", "amount": "10"},
+                    {"from": "USD", "to": "GBP", "amount": "52"},
+                ]
+            },
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert [q["converted"] for q in response.json()["quotes"]] == ["52.00", "40.00"]
+
+
+class TestMetricsAPI:
+    async def test_metrics_cover_routes_repositories_and_caches(
+        self, authorized_client: AsyncClient
+    ) -> None:
+        await authorized_client.get("/api/v1/wallet")
+        await authorized_client.get("/api/v1/wallet")
+
+        response = await authorized_client.get("/metrics")
+        assert response.status_code == status.HTTP_200_OK
+        body = response.text
+        assert (
+            'http_request_duration_seconds_count{method="GET",route="/api/v1/wallet",status="200"}'
+            in body
+        )
+        assert 'repository_operation_duration_seconds_count{collection="wallets"' in body
+        assert 'cache_requests_total{cache="wallet",result="hit"}' in body
+        assert 'exchange_rates_lookup_duration_seconds_count{source="hit"}' in body
+        assert 'app_startup_duration_seconds{phase="first_wallet_response"}' in body
+        assert "password_hash_queue_depth" in body
+
+
+class TestAdminAPI:
+    @pytest.fixture
+    def admin_headers(self, monkeypatch: pytest.MonkeyPatch) -> dict:
+        monkeypatch.setattr("app.api.deps.settings.ADMIN_EMAILS", ["admin@example.com"])
+        token = create_access_token({"sub": "admin", "email": "admin@example.com"})
+        return {"Authorization": f"Bearer {token}"}
+
+    async def test_health_stats_requires_admin(
+        self, client: AsyncClient, authorized_client: AsyncClient, admin_headers: dict
+    ) -> None:
+        assert (await client.get("/health/stats")).status_code == status.HTTP_403_FORBIDDEN
+        response = await authorized_client.get("/health/stats")
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+        response = await authorized_client.get("/health/stats", headers=admin_headers)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["password_hasher"]["queued"] == 0
+
+    async def test_export_requires_admin(self, authorized_client: AsyncClient) -> None:
+        response = await authorized_client.get("/api/v1/admin/wallets/export")
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    async def test_export_ndjson(
+        self, client: AsyncClient, admin_headers: dict, mock_db_client: AsyncMongoMockClient
+    ) -> None:
+        await mock_db_client.wallet_app.wallets.insert_one(
+            {"user_id": "export_user", "balances": {"EUR": 10.0, "PLN": 5.0}}
+        )
+
+        response = await client.get("/api/v1/admin/wallets/export", headers=admin_headers)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"] == "application/x-ndjson"
+
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        exported = next(line for line in lines if line["user_id"] == "export_user")
+        assert exported["pln_values"] == {"EUR": "45.00", "PLN": "5.00"}
+        assert exported["total_pln"] == "50.00"
+
+    async def test_export_csv(self, client: AsyncClient, admin_headers: dict) -> None:
+        response = await client.get(
+            "/api/v1/admin/wallets/export", params={"format": "csv"}, headers=admin_headers
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert response.text.startswith("user_id,currency,amount,pln_value")
@@ -1,11 +1,56 @@
+import asyncio
+import dataclasses
+import time
+from datetime import date, timedelta
 from decimal import Decimal
+from types import SimpleNamespace
+from typing import Any
+from unittest.mock import AsyncMock, Mock, call
 
+import httpx
+import orjson
 import pytest
+from bson import ObjectId
+from fakeredis.aioredis import FakeRedis
+from mongomock_motor import AsyncMongoMockClient
+from redis.exceptions import ConnectionError as RedisConnectionError
 
-from app.core.exceptions import InsufficientFundsError, InvalidCurrencyError
-from app.models.schemas.wallet import WalletOperation
+from app.commands.compact_ledger import compact_ledger
+from app.commands.ingest_rates import ingest_rates
+from app.commands.migrate_balances import MIGRATION_ID, migrate_balances
+from app.commands.snapshot_valuations import main as snapshot_valuations_main
+from app.commands.snapshot_valuations import snapshot_valuations
+from app.config import get_settings
+from app.core.circuit_breaker import CircuitBreaker, CircuitOpenError
+from app.core.database import PoolStatsListener
+from app.core.exceptions import (
+    ExchangeRateError,
+    IdempotencyInProgressError,
+    InsufficientFundsError,
+    InvalidCurrencyError,
+    RateLimitExceededError,
+    ServiceOverloadedError,
+)
+from app.core.idempotency import REPLAYED_HEADER, IdempotencyStore, _fingerprint
+from app.core.invalidation import InvalidationBus
+from app.core.rate_limit import RateLimit, RateLimiter
+from app.core.security import PasswordHasher, TokenCache
+from app.models.domain.rates import RatesSnapshot
+from app.models.domain.wallet import Wallet
+from app.models.schemas.rates import ConversionRequest
+from app.models.schemas.wallet import WalletBatchItem, WalletOperation
+from app.models.utils import get_current_time
+from app.repositories.ledger import LedgerFlusher, LedgerRepository
+from app.repositories.rates import RateHistoryRepository
+from app.repositories.valuations import ValuationRepository
+from app.repositories.wallet import WalletRepository
+from app.services.coalescer import WriteCoalescer
 from app.services.exchange import ExchangeRateService
-from app.services.wallet import WalletService
+from app.services.wallet import WalletService, wallet_etag
+from app.services.wallet_events import WalletEventHub
+from tests.conftest import MOCK_EXCHANGE_RATES
+
+settings = get_settings()
 
 pytestmark = pytest.mark.asyncio
 
@@ -25,6 +70,19 @@ class TestWalletService:
         assert "EUR" in result.pln_values
         assert result.total_pln > Decimal("0")
 
+    async def test_mutation_does_not_reread_wallet(
+        self, wallet_service: WalletService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        get_wallet = AsyncMock()
+        monkeypatch.setattr(wallet_service.wallet_repository, "get_wallet", get_wallet)
+
+        result = await wallet_service.add_funds(
+            "no_reread_user", WalletOperation(currency="USD", amount=Decimal("5.00"))
+        )
+
+        assert result.balances["USD"] == Decimal("5.00")
+        get_wallet.assert_not_awaited()
+
     async def test_insufficient_funds(self, wallet_service: WalletService) -> None:
         operation = WalletOperation(currency="USD", amount=Decimal("50.00"))
 
@@ -37,6 +95,273 @@ class TestWalletService:
         with pytest.raises(InvalidCurrencyError):
             await wallet_service.add_funds("test_user", operation)
 
+    async def test_batch_guards_every_intermediate_balance(
+        self, wallet_service: WalletService
+    ) -> None:
+        operations = [
+            WalletBatchItem(operation="subtract", currency="USD", amount=Decimal("10.00")),
+            WalletBatchItem(operation="add", currency="USD", amount=Decimal("10.00")),
+        ]
+
+        with pytest.raises(InsufficientFundsError):
+            await wallet_service.apply_batch("batch_user", operations)
+
+    async def test_etag_changes_with_balances_and_rates_table(self) -> None:
+        wallet = Wallet(user_id="etag_user", balances={"EUR": Decimal("1.00")})
+        snapshot = RatesSnapshot({"EUR": Decimal("4.50")}, "2024-01-02", get_current_time())
+        etag = wallet_etag(wallet, snapshot)
+
+        assert etag == wallet_etag(wallet.model_copy(), snapshot)
+        assert etag != wallet_etag(
+            wallet, dataclasses.replace(snapshot, effective_date="2024-01-03")
+        )
+        assert etag != wallet_etag(wallet, dataclasses.replace(snapshot, stale=True))
+        # coalesced writes share one updated_at
+        changed = wallet.model_copy(update={"balances": {"EUR": Decimal("2.00")}})
+        assert etag != wallet_etag(changed, snapshot)
+
+
+class TestWriteCoalescing:
+    @pytest.fixture
+    def coalescing_service(
+        self, wallet_repository: WalletRepository, exchange_service: ExchangeRateService
+    ) -> WalletService:
+        return WalletService(
+            wallet_repository, exchange_service, write_coalescer=WriteCoalescer(0.05, 50)
+        )
+
+    async def test_concurrent_writes_become_one_update(
+        self, coalescing_service: WalletService, wallet_repository: WalletRepository
+    ) -> None:
+        user_id = f"coalesce_{ObjectId()}"
+        apply = Mock(wraps=wallet_repository.apply_operations)
+        wallet_repository.apply_operations = apply
+
+        results = await asyncio.gather(
+            coalescing_service.add_funds(user_id, WalletOperation(currency="EUR", amount="10")),
+            coalescing_service.add_funds(user_id, WalletOperation(currency="USD", amount="5")),
+            coalescing_service.subtract_funds(user_id, WalletOperation(currency="EUR", amount="4")),
+        )
+
+        assert apply.call_count == 1
+        assert [r.balances for r in results] == [
+            {"EUR": Decimal("10.00")},
+            {"EUR": Decimal("10.00"), "USD": Decimal("5.00")},
+            {"EUR": Decimal("6.00"), "USD": Decimal("5.00")},
+        ]
+        # only the last result is the stored document, the one the response cache may hold
+        assert [r.version for r in results] == [None, None, 1]
+
+    async def test_overdraft_fails_only_its_own_request(
+        self, coalescing_service: WalletService
+    ) -> None:
+        user_id = f"coalesce_{ObjectId()}"
+
+        results = await asyncio.gather(
+            coalescing_service.add_funds(user_id, WalletOperation(currency="EUR", amount="10")),
+            coalescing_service.subtract_funds(
+                user_id, WalletOperation(currency="EUR", amount="50")
+            ),
+            coalescing_service.add_funds(user_id, WalletOperation(currency="EUR", amount="5")),
+            return_exceptions=True,
+        )
+
+        assert results[0].balances == {"EUR": Decimal("10.00")}
+        assert isinstance(results[1], InsufficientFundsError)
+        assert results[2].balances == {"EUR": Decimal("15.00")}
+
+    async def test_existing_empty_currency_is_kept_in_earlier_results(
+        self, coalescing_service: WalletService
+    ) -> None:
+        user_id = f"coalesce_{ObjectId()}"
+        await coalescing_service.get_wallet(user_id)
+
+        results = await asyncio.gather(
+            coalescing_service.add_funds(user_id, WalletOperation(currency="EUR", amount="10")),
+            coalescing_service.add_funds(user_id, WalletOperation(currency="PLN", amount="5")),
+            coalescing_service.add_funds(user_id, WalletOperation(currency="USD", amount="0.01")),
+        )
+
+        assert [r.balances for r in results] == [
+            {"PLN": Decimal("0.00"), "EUR": Decimal("10.00")},
+            {"PLN": Decimal("5.00"), "EUR": Decimal("10.00")},
+            {"PLN": Decimal("5.00"), "EUR": Decimal("10.00"), "USD": Decimal("0.01")},
+        ]
+
+
+class TestWalletRepository:
+    async def test_balances_stored_as_minor_units(
+        self, wallet_repository: WalletRepository
+    ) -> None:
+        wallet = await wallet_repository.update_balance("minor_user", "EUR", Decimal("10.10"))
+
+        assert wallet.balances["EUR"] == Decimal("10.10")
+        document = await wallet_repository.collection.find_one({"user_id": "minor_user"})
+        assert document["balances_minor"] == {"EUR": 1010}
+
+    async def test_update_returns_the_stored_wallet(
+        self, wallet_repository: WalletRepository
+    ) -> None:
+        await wallet_repository.update_balance("stored_user", "EUR", Decimal("1.00"))
+        wallet = await wallet_repository.apply_operations(
+            "stored_user", [("EUR", Decimal("-0.50")), ("USD", Decimal("2.00"))]
+        )
+
+        stored = await wallet_repository.get_wallet("stored_user")
+        assert wallet.model_dump(exclude={"id"}) == stored.model_dump(exclude={"id"})
+        assert wallet.created_currencies == {"USD"}
+
+    async def test_subtract_migrates_legacy_wallet(
+        self, wallet_repository: WalletRepository
+    ) -> None:
+        await wallet_repository.collection.insert_one(
+            {"user_id": "legacy_user", "balances": {"USD": 30.1}}
+        )
+
+        wallet = await wallet_repository.update_balance(
+            "legacy_user", "USD", Decimal("10.05"), subtract=True
+        )
+
+        assert wallet.balances == {"USD": Decimal("20.05")}
+        document = await wallet_repository.collection.find_one({"user_id": "legacy_user"})
+        assert "balances" not in document
+
+    async def test_migrate_balances_checkpoints_progress(
+        self, mock_db_client: AsyncMongoMockClient
+    ) -> None:
+        db = mock_db_client.migration_test
+        legacy_wallets = [{"user_id": f"user_{i}", "balances": {"EUR": i + 0.1}} for i in range(3)]
+        await db.wallets.insert_many(legacy_wallets)
+
+        migrated = await migrate_balances(db.wallets, db.migrations, batch_size=2)
+
+        assert migrated == len(legacy_wallets)
+        assert await db.wallets.count_documents({"balances": {"$exists": True}}) == 0
+        document = await db.wallets.find_one({"user_id": "user_2"})
+        assert document["balances_minor"] == {"EUR": 210}
+        assert await db.migrations.find_one({"_id": MIGRATION_ID}) is not None
+
+
+class TestWalletLedger:
+    @pytest.fixture
+    async def repository(self, mock_db_client: AsyncMongoMockClient) -> WalletRepository:
+        db = mock_db_client.ledger_test
+        await db.wallet_ledger.create_index([("user_id", 1), ("seq", 1)], unique=True)
+        ledger = LedgerRepository(db.wallet_ledger, db.wallet_snapshots, snapshot_interval=2)
+        return WalletRepository(db.wallets, ledger)
+
+    async def test_operations_are_recorded_in_order(self, repository: WalletRepository) -> None:
+        await repository.update_balance("ledger_user", "EUR", Decimal("10.00"))
+        await repository.update_balance("ledger_user", "EUR", Decimal("3.00"), subtract=True)
+        await repository.apply_operations(
+            "ledger_user", [("USD", Decimal("5.00")), ("EUR", Decimal("1.50"))]
+        )
+
+        entries = await repository.ledger.list_entries("ledger_user", limit=10)
+
+        assert [(e.seq, e.currency, e.amount, e.balance_after) for e in entries] == [
+            (4, "EUR", Decimal("1.50"), Decimal("8.50")),
+            (3, "USD", Decimal("5.00"), Decimal("5.00")),
+            (2, "EUR", Decimal("-3.00"), Decimal("7.00")),
+            (1, "EUR", Decimal("10.00"), Decimal("10.00")),
+        ]
+        document = await repository.collection.find_one({"user_id": "ledger_user"})
+        assert document["pending_entries"] == []
+
+    async def test_rebuild_from_snapshot_and_tail(self, repository: WalletRepository) -> None:
+        for amount in ("1.00", "2.00", "3.00"):
+            await repository.update_balance("rebuild_user", "GBP", Decimal(amount))
+
+        assert await repository.ledger.latest_snapshot_seq("rebuild_user") == len(["1", "2"])
+        assert await repository.ledger.rebuild_balances("rebuild_user") == {"GBP": 600}
+        assert await repository.ledger.rebuild_balances("rebuild_user", at_seq=1) == {"GBP": 100}
+
+    async def test_flush_runs_after_the_update_returns(self, repository: WalletRepository) -> None:
+        release = asyncio.Event()
+        flush = repository.ledger.flush
+
+        async def held_flush(*args: Any) -> None:
+            await release.wait()
+            await flush(*args)
+
+        repository.ledger.flush = held_flush
+        repository.flusher = LedgerFlusher(workers=1, max_queued=10)
+        repository.flusher.start()
+
+        wallet = await repository.update_balance("queued_user", "EUR", Decimal("10.00"))
+
+        assert wallet.balances == {"EUR": Decimal("10.00")}
+        document = await repository.collection.find_one({"user_id": "queued_user"})
+        assert [entry["amount"] for entry in document["pending_entries"]] == [1000]
+
+        release.set()
+        await repository.flusher.close()
+        entries = await repository.ledger.list_entries("queued_user", limit=10)
+        assert [(e.seq, e.balance_after) for e in entries] == [(1, Decimal("10.00"))]
+        document = await repository.collection.find_one({"user_id": "queued_user"})
+        assert document["pending_entries"] == []
+
+    async def test_pending_entries_are_flushed_before_reading(
+        self, repository: WalletRepository
+    ) -> None:
+        await repository.collection.insert_one(
+            {
+                "user_id": "unflushed_user",
+                "balances_minor": {"EUR": 250},
+                "seq": 1,
+                "pending_entries": [
+                    {
+                        "_id": ObjectId(),
+                        "currency": "EUR",
+                        "amount": 250,
+                        "created_at": get_current_time(),
+                    }
+                ],
+            }
+        )
+
+        await repository.flush_pending_ledger("unflushed_user")
+        await repository.flush_pending_ledger("missing_user")
+
+        entries = await repository.ledger.list_entries("unflushed_user", limit=10)
+        assert [(e.seq, e.balance_after) for e in entries] == [(1, Decimal("2.50"))]
+
+    async def test_compaction_flushes_stranded_entries(self, repository: WalletRepository) -> None:
+        await repository.update_balance("stranded_user", "EUR", Decimal("4.00"))
+        entry = {
+            "_id": ObjectId(),
+            "currency": "EUR",
+            "amount": 100,
+            "created_at": get_current_time(),
+        }
+        await repository.collection.update_one(
+            {"user_id": "stranded_user"},
+            {"$inc": {"seq": 1, "balances_minor.EUR": 100}, "$push": {"pending_entries": entry}},
+        )
+
+        stats = await compact_ledger(repository, batch_size=10)
+
+        assert stats["flushed"] >= 1
+        entries = await repository.ledger.list_entries("stranded_user", limit=10)
+        assert entries[0].seq == len(entries)
+        assert entries[0].balance_after == Decimal("5.00")
+
+    async def test_compaction_snapshots_wallets_behind_in_one_query(
+        self, repository: WalletRepository, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        await repository.update_balance("behind_user", "EUR", Decimal("1.00"))
+        # two entries past the latest snapshot, written without one, as after a crash
+        await repository.collection.update_one({"user_id": "behind_user"}, {"$inc": {"seq": 2}})
+        latest_snapshot_seq = AsyncMock()
+        monkeypatch.setattr(repository.ledger, "latest_snapshot_seq", latest_snapshot_seq)
+
+        await compact_ledger(repository, batch_size=10)
+
+        latest_snapshot_seq.assert_not_awaited()
+        seqs = await repository.ledger.latest_snapshot_seqs()
+        document = await repository.collection.find_one({"user_id": "behind_user"})
+        assert seqs["behind_user"] == document["seq"]
+
 
 class TestExchangeService:
     async def test_get_current_rates(self, exchange_service: ExchangeRateService) -> None:
@@ -62,3 +387,736 @@ class TestExchangeService:
         assert "EUR" in pln_values
         assert "USD" in pln_values
         assert all(isinstance(v, Decimal) for v in pln_values.values())
+
+    async def test_convert_uses_cross_rate_matrix(
+        self, exchange_service: ExchangeRateService
+    ) -> None:
+        conversions = [
+            ConversionRequest(from_currency="EUR", to_currency="USD", amount=Decimal("100")),
+            ConversionRequest(from_currency="USD", to_currency="EUR", amount=Decimal("100")),
+            ConversionRequest(from_currency="PLN", to_currency="GBP", amount=Decimal("52")),
+        ]
+
+        response = await exchange_service.convert(conversions)
+
+        assert [(q.rate, q.converted) for q in response.quotes] == [
+            (Decimal("1.125"), Decimal("112.50")),
+            (Decimal("0.8888888888888888888888888889"), Decimal("88.89")),
+            (Decimal("0.1923076923076923076923076923"), Decimal("10.00")),
+        ]
+        cross_rates = await exchange_service.get_cross_rates()
+        assert cross_rates.snapshot is exchange_service.snapshot
+        assert cross_rates.rate("EUR", "EUR") == Decimal("1")
+
+        with pytest.raises(InvalidCurrencyError):
+            await exchange_service.convert(
+                [ConversionRequest(from_currency="EUR", to_currency="XXX", amount=Decimal("1"))]
+            )
+
+    async def test_convert_keeps_precision_of_small_rates(
+        self, exchange_service: ExchangeRateService
+    ) -> None:
+        exchange_service._snapshot = RatesSnapshot(
+            {"HUF": Decimal("0.0112"), "EUR": Decimal("4.50")}, None, get_current_time()
+        )
+
+        response = await exchange_service.convert(
+            [ConversionRequest(from_currency="HUF", to_currency="EUR", amount=Decimal("1000000"))]
+        )
+
+        # a rate rounded to six places, 0.002489, would give 2489.00
+        assert response.quotes[0].converted == Decimal("2488.89")
+
+    async def test_fetch_rates_retries_transient_errors(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr("app.services.exchange.settings.NBP_RETRY_BACKOFF", 0)
+        response = Mock(json=Mock(return_value=MOCK_EXCHANGE_RATES), raise_for_status=Mock())
+        exchange_service.client = AsyncMock()
+        exchange_service.client.get.side_effect = [httpx.ConnectError("boom"), response]
+
+        rates = (await exchange_service._fetch_rates()).rates
+
+        assert rates["EUR"] == Decimal("4.50")
+        assert exchange_service.client.get.await_count == 2  # noqa: PLR2004
+
+    async def test_fetch_rates_returns_a_snapshot_of_the_table(
+        self, exchange_service: ExchangeRateService
+    ) -> None:
+        before = get_current_time()
+
+        snapshot = await exchange_service._fetch_rates()
+
+        assert isinstance(snapshot, RatesSnapshot)
+        assert snapshot.rates == {
+            "EUR": Decimal("4.50"),
+            "USD": Decimal("4.00"),
+            "GBP": Decimal("5.20"),
+        }
+        assert snapshot.fetched_at >= before
+        assert not snapshot.stale
+
+    async def test_fetch_rates_gives_up_after_retries(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr("app.services.exchange.settings.NBP_RETRY_BACKOFF", 0)
+        exchange_service.client = AsyncMock()
+        exchange_service.client.get.side_effect = httpx.ReadTimeout("slow")
+
+        with pytest.raises(ExchangeRateError):
+            await exchange_service._fetch_rates()
+
+    async def test_concurrent_misses_share_one_fetch(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr(exchange_service, "_read_shared_snapshot", AsyncMock(return_value=None))
+        fetched = get_current_time()
+        fetch = AsyncMock(return_value=RatesSnapshot({"EUR": Decimal("4.50")}, None, fetched))
+        monkeypatch.setattr(exchange_service, "_fetch_rates", fetch)
+
+        results = await asyncio.gather(*(exchange_service.get_current_rates() for _ in range(10)))
+
+        assert all(rates == {"EUR": Decimal("4.50")} for rates in results)
+        fetch.assert_awaited_once()
+
+    async def test_expired_rates_served_while_revalidating(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        expired_at = get_current_time() - timedelta(seconds=settings.EXCHANGE_RATES_CACHE_TTL + 1)
+        exchange_service._snapshot = RatesSnapshot({"EUR": Decimal("4.00")}, None, expired_at)
+        monkeypatch.setattr(exchange_service, "_read_shared_snapshot", AsyncMock(return_value=None))
+
+        rates = await exchange_service.get_current_rates()
+        assert rates == {"EUR": Decimal("4.00")}
+
+        assert exchange_service._inflight is not None
+        await exchange_service._inflight
+        assert (await exchange_service.get_current_rates())["EUR"] == Decimal("4.50")
+
+    async def test_open_circuit_serves_last_known_good_rates(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr("app.services.exchange.settings.NBP_RETRY_BACKOFF", 0)
+        monkeypatch.setattr(exchange_service, "_read_shared_snapshot", AsyncMock(return_value=None))
+        expired_at = get_current_time() - timedelta(
+            seconds=settings.EXCHANGE_RATES_CACHE_TTL + settings.EXCHANGE_RATES_STALE_TTL + 1
+        )
+        exchange_service._snapshot = RatesSnapshot(
+            {"EUR": Decimal("4.00")}, "2024-01-01", expired_at
+        )
+        exchange_service.client = AsyncMock()
+        exchange_service.client.get.side_effect = httpx.ReadTimeout("slow")
+
+        for _ in range(settings.NBP_CIRCUIT_FAILURE_THRESHOLD):
+            snapshot = await exchange_service.get_snapshot()
+            assert snapshot.stale
+            assert snapshot.rates == {"EUR": Decimal("4.00")}
+        attempts = exchange_service.client.get.await_count
+
+        # the circuit is open: no more requests to NBP, no refresh
+        assert exchange_service.breaker.state == "open"
+        assert (await exchange_service.get_snapshot()).stale
+        assert exchange_service._inflight is None
+        with pytest.raises(ExchangeRateError):
+            await exchange_service._fetch_rates()
+        assert exchange_service.client.get.await_count == attempts
+
+    async def test_fallback_reads_latest_stored_table(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        stored = RatesSnapshot(
+            {"EUR": Decimal("4.20")}, "2024-01-05", get_current_time() - timedelta(days=2)
+        )
+        exchange_service.history = AsyncMock(get_latest=AsyncMock(return_value=stored))
+        monkeypatch.setattr(exchange_service, "_read_shared_snapshot", AsyncMock(return_value=None))
+        monkeypatch.setattr(
+            exchange_service, "_fetch_rates", AsyncMock(side_effect=ExchangeRateError())
+        )
+
+        response = await exchange_service.convert(
+            [ConversionRequest(from_currency="EUR", to_currency="PLN", amount=Decimal("10"))]
+        )
+
+        assert response.rates_stale
+        assert response.quotes[0].converted == Decimal("42.00")
+
+    async def test_no_fallback_raises(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr(exchange_service, "_read_shared_snapshot", AsyncMock(return_value=None))
+        monkeypatch.setattr(
+            exchange_service, "_fetch_rates", AsyncMock(side_effect=ExchangeRateError())
+        )
+
+        with pytest.raises(ExchangeRateError):
+            await exchange_service.get_snapshot()
+
+    async def test_lookup_is_labelled_with_where_the_table_came_from(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        histogram = Mock()
+        monkeypatch.setattr("app.services.exchange.EXCHANGE_RATES_LOOKUP_DURATION", histogram)
+        shared = RatesSnapshot({"EUR": Decimal("4.20")}, "2024-01-05", get_current_time())
+        monkeypatch.setattr(
+            exchange_service, "_read_shared_snapshot", AsyncMock(return_value=shared)
+        )
+        exchange_service._snapshot = None
+
+        await exchange_service.get_snapshot()
+        expired_at = get_current_time() - timedelta(
+            seconds=settings.EXCHANGE_RATES_CACHE_TTL + settings.EXCHANGE_RATES_STALE_TTL + 1
+        )
+        exchange_service._snapshot = dataclasses.replace(shared, fetched_at=expired_at)
+        exchange_service._read_shared_snapshot.return_value = None
+        monkeypatch.setattr(
+            exchange_service, "_fetch_rates", AsyncMock(side_effect=ExchangeRateError())
+        )
+        await exchange_service.get_snapshot()
+
+        assert histogram.labels.call_args_list == [call("redis"), call("fallback")]
+
+    async def test_warm_start_serves_stored_table_while_refreshing(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        stored = RatesSnapshot(
+            {"EUR": Decimal("4.20")}, "2024-01-05", get_current_time() - timedelta(days=2)
+        )
+        exchange_service.history = AsyncMock(get_latest=AsyncMock(return_value=stored))
+        monkeypatch.setattr(exchange_service, "_read_shared_snapshot", AsyncMock(return_value=None))
+        fetched = asyncio.Event()
+
+        async def fetch_rates() -> RatesSnapshot:
+            await fetched.wait()
+            return RatesSnapshot({"EUR": Decimal("4.50")}, "2024-01-08", get_current_time())
+
+        monkeypatch.setattr(exchange_service, "_fetch_rates", fetch_rates)
+
+        assert (await exchange_service.warm()).stale
+        exchange_service.start()
+
+        # the refresh is still waiting on NBP, requests are answered from the stored table
+        snapshot = await exchange_service.get_snapshot()
+        assert snapshot.stale
+        assert snapshot.rates == {"EUR": Decimal("4.20")}
+
+        fetched.set()
+        await exchange_service._inflight
+        assert not (await exchange_service.get_snapshot()).stale
+
+    async def test_warm_start_gives_up_on_slow_storage(
+        self, exchange_service: ExchangeRateService, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        monkeypatch.setattr("app.services.exchange.settings.EXCHANGE_RATES_WARM_TIMEOUT", 0.01)
+
+        async def read_shared_snapshot() -> None:
+            await asyncio.sleep(1)
+
+        monkeypatch.setattr(exchange_service, "_read_shared_snapshot", read_shared_snapshot)
+
+        assert await exchange_service.warm() is None
+        assert exchange_service.snapshot is None
+
+
+class TestCircuitBreaker:
+    def _fail(self, breaker: CircuitBreaker) -> None:
+        with pytest.raises(RuntimeError), breaker:
+            raise RuntimeError()
+
+    async def test_opens_after_consecutive_failures(self) -> None:
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+        self._fail(breaker)
+        assert breaker.state == "closed"
+        self._fail(breaker)
+        assert breaker.state == "open"
+
+        with pytest.raises(CircuitOpenError), breaker:
+            pass
+        assert breaker.stats()["rejected"] == 1
+
+    async def test_half_open_lets_one_trial_through(self) -> None:
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        self._fail(breaker)
+        await asyncio.sleep(0.02)
+        assert breaker.state == "half_open"
+
+        with breaker:
+            # a second caller while the trial is in flight is rejected
+            with pytest.raises(CircuitOpenError), breaker:
+                pass
+        assert breaker.state == "closed"
+
+    async def test_failed_trial_reopens(self) -> None:
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.01)
+        for _ in range(3):
+            self._fail(breaker)
+        await asyncio.sleep(0.02)
+
+        self._fail(breaker)
+        assert breaker.state == "open"
+
+
+class TestRateHistory:
+    @pytest.fixture
+    async def history(self, mock_db_client: AsyncMongoMockClient) -> RateHistoryRepository:
+        collection = mock_db_client.history_test.exchange_rate_tables
+        await collection.delete_many({})
+        return RateHistoryRepository(collection)
+
+    async def test_as_of_resolves_latest_table_on_or_before_date(
+        self, history: RateHistoryRepository
+    ) -> None:
+        now = get_current_time()
+        await history.save_table(RatesSnapshot({"EUR": Decimal("4.30")}, "2024-01-02", now))
+        await history.save_table(RatesSnapshot({"EUR": Decimal("4.40")}, "2024-01-05", now))
+
+        snapshot = await history.get_as_of(date(2024, 1, 4))
+
+        assert snapshot is not None
+        assert snapshot.effective_date == "2024-01-02"
+        assert snapshot.rates == {"EUR": Decimal("4.30")}
+        assert await history.get_as_of(date(2024, 1, 1)) is None
+        assert await history.latest_effective_date() == date(2024, 1, 5)
+
+    async def test_ingest_splits_range_into_nbp_windows(
+        self, history: RateHistoryRepository, exchange_service: ExchangeRateService
+    ) -> None:
+        table = RatesSnapshot({"EUR": Decimal("4.30")}, "2024-03-01", get_current_time())
+        exchange_service.fetch_tables = AsyncMock(return_value=[table])
+
+        stored = await ingest_rates(exchange_service, history, date(2024, 1, 1), date(2024, 6, 30))
+
+        windows = exchange_service.fetch_tables.await_args_list
+        assert [call.args for call in windows] == [
+            (date(2024, 1, 1), date(2024, 4, 2)),
+            (date(2024, 4, 3), date(2024, 6, 30)),
+        ]
+        assert stored == len(windows)
+        assert (await history.get_as_of(date(2024, 3, 1))) is not None
+
+
+class TestValuationSnapshots:
+    async def test_job_skips_unchanged_wallets_and_series_carries_points(
+        self, mock_db_client: AsyncMongoMockClient
+    ) -> None:
+        db = mock_db_client.valuations_test
+        for collection in (db.wallets, db.wallet_valuations, db.jobs):
+            await collection.delete_many({})
+        wallets = WalletRepository(db.wallets)
+        valuations = ValuationRepository(db.wallet_valuations)
+        await wallets.update_balance("eur-user", "EUR", Decimal("10.00"))
+        await wallets.update_balance("pln-user", "PLN", Decimal("5.00"))
+
+        runs = [
+            ({"EUR": Decimal("4.30")}, date(2024, 1, 1)),
+            ({"EUR": Decimal("4.30")}, date(2024, 1, 2)),
+            ({"EUR": Decimal("4.40")}, date(2024, 1, 3)),
+        ]
+        written = [
+            await snapshot_valuations(wallets, valuations, db.jobs, rates, day)
+            for rates, day in runs
+        ]
+        # unchanged wallets are skipped; only the EUR wallet is revalued when its rate moves
+        assert written == [2, 0, 1]
+
+        points = await valuations.get_series("eur-user", date(2024, 1, 2), date(2024, 1, 5))
+        assert [point.date for point in points] == [date(2024, 1, 2), date(2024, 1, 3)]
+        assert [point.total_pln for point in points] == [Decimal("43.00"), Decimal("44.00")]
+        assert points[0].balances == {"EUR": Decimal("10.00")}
+
+    async def test_backfill_values_every_wallet_and_keeps_job_state(
+        self, mock_db_client: AsyncMongoMockClient
+    ) -> None:
+        db = mock_db_client.valuations_backfill_test
+        for collection in (db.wallets, db.wallet_valuations, db.jobs):
+            await collection.delete_many({})
+        wallets = WalletRepository(db.wallets)
+        valuations = ValuationRepository(db.wallet_valuations)
+        await wallets.update_balance("eur-user", "EUR", Decimal("10.00"))
+        await snapshot_valuations(
+            wallets, valuations, db.jobs, {"EUR": Decimal("4.40")}, date(2024, 1, 3)
+        )
+        state = await db.jobs.find_one({"_id": "valuation_snapshots"})
+
+        written = await snapshot_valuations(
+            wallets,
+            valuations,
+            db.jobs,
+            {"EUR": Decimal("4.30")},
+            date(2024, 1, 2),
+            incremental=False,
+        )
+
+        assert written == 1
+        points = await valuations.get_series("eur-user", date(2024, 1, 2), date(2024, 1, 2))
+        assert [point.total_pln for point in points] == [Decimal("43.00")]
+        assert await db.jobs.find_one({"_id": "valuation_snapshots"}) == state
+
+    async def test_command_values_wallets_with_stored_rates(
+        self, mock_db_client: AsyncMongoMockClient, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        db = mock_db_client.valuations_command_test
+        for collection in (db.wallets, db.wallet_valuations, db.jobs, db.exchange_rate_tables):
+            await collection.delete_many({})
+        await WalletRepository(db.wallets).update_balance("eur-user", "EUR", Decimal("10.00"))
+        await RateHistoryRepository(db.exchange_rate_tables).save_table(
+            RatesSnapshot({"EUR": Decimal("4.30")}, "2024-01-02", get_current_time())
+        )
+        client = SimpleNamespace(wallet_app=db, close=Mock())
+        monkeypatch.setattr(
+            "app.commands.snapshot_valuations.create_mongo_client", lambda *args: client
+        )
+        monkeypatch.setattr("sys.argv", ["snapshot_valuations", "--date", "2024-01-03"])
+
+        await snapshot_valuations_main()
+
+        points = await ValuationRepository(db.wallet_valuations).get_series(
+            "eur-user", date(2024, 1, 3), date(2024, 1, 3)
+        )
+        assert [point.total_pln for point in points] == [Decimal("43.00")]
+        client.close.assert_called_once()
+
+
+class TestPoolStatsListener:
+    async def test_checkout_wait_tracking(self) -> None:
+        listener = PoolStatsListener()
+        listener.connection_created(SimpleNamespace())
+        listener.connection_check_out_started(SimpleNamespace())
+        assert listener.snapshot()["waiting"] == 1
+
+        listener.connection_checked_out(SimpleNamespace(duration=0.02))
+        stats = listener.snapshot()
+        assert stats["waiting"] == 0
+        assert stats["checked_out"] == 1
+        assert stats["checkout_wait_max_ms"] == pytest.approx(20.0)
+
+        listener.connection_checked_in(SimpleNamespace())
+        assert listener.snapshot()["checked_out"] == 0
+
+
+class TestPasswordHasher:
+    async def test_hash_and_verify(self) -> None:
+        hasher = PasswordHasher(max_workers=2, max_queue=2)
+        hashed = await hasher.hash("secret")
+
+        assert await hasher.verify("secret", hashed)
+        assert not await hasher.verify("wrong", hashed)
+        hasher.shutdown()
+
+    async def test_sheds_load_when_queue_is_full(self) -> None:
+        hasher = PasswordHasher(max_workers=1, max_queue=0)
+
+        results = await asyncio.gather(
+            hasher.hash("first"), hasher.hash("second"), return_exceptions=True
+        )
+
+        assert isinstance(results[0], str)
+        assert isinstance(results[1], ServiceOverloadedError)
+        assert hasher.stats()["rejected"] == 1
+        hasher.shutdown()
+
+
+class TestTokenCache:
+    async def test_hit_and_miss_counters(self) -> None:
+        cache = TokenCache(maxsize=10)
+        assert cache.get("token") is None
+
+        cache.set("token", {"sub": "user", "exp": time.time() + 60})
+
+        assert cache.get("token") == {"sub": "user", "exp": pytest.approx(time.time() + 60, abs=5)}
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    async def test_expired_tokens_are_not_served(self) -> None:
+        cache = TokenCache(maxsize=10)
+        cache.set("token", {"sub": "user", "exp": time.time() - 1})
+
+        assert cache.get("token") is None
+
+    async def test_evicts_least_recently_used(self) -> None:
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.set("first", {"sub": "1", "exp": exp})
+        cache.set("second", {"sub": "2", "exp": exp})
+        cache.get("first")
+        cache.set("third", {"sub": "3", "exp": exp})
+
+        assert cache.get("second") is None
+        assert cache.get("first") is not None
+
+
+class TestRateLimiter:
+    @pytest.fixture
+    async def redis(self) -> FakeRedis:
+        redis = FakeRedis()
+        await redis.flushall()
+        return redis
+
+    async def test_empty_bucket_rejects_every_request_that_shares_it(
+        self, redis: FakeRedis
+    ) -> None:
+        limiter = RateLimiter(redis, {"wallet_write": RateLimit(capacity=2, period=60)})
+
+        await limiter.hit("wallet_write", ["user:a", "ip:1.2.3.4"])
+        await limiter.hit("wallet_write", ["user:b", "ip:1.2.3.4"])
+        with pytest.raises(RateLimitExceededError) as exc_info:
+            await limiter.hit("wallet_write", ["user:c", "ip:1.2.3.4"])
+        assert int(exc_info.value.headers["Retry-After"]) > 0
+
+        # a rejected bucket answers locally until it refills
+        limiter._script = AsyncMock()
+        with pytest.raises(RateLimitExceededError):
+            await limiter.hit("wallet_write", ["user:d", "ip:1.2.3.4"])
+        limiter._script.assert_not_awaited()
+
+    async def test_denied_request_takes_no_tokens(self, redis: FakeRedis) -> None:
+        limiter = RateLimiter(redis, {"auth": RateLimit(capacity=1, period=60)})
+
+        await limiter.hit("auth", ["user:a"])
+        with pytest.raises(RateLimitExceededError):
+            await limiter.hit("auth", ["ip:5.6.7.8", "user:a"])
+
+        await limiter.hit("auth", ["ip:5.6.7.8"])
+
+    async def test_bucket_refills_over_time(self, redis: FakeRedis) -> None:
+        limiter = RateLimiter(redis, {"auth": RateLimit(capacity=1, period=0.05)})
+
+        await limiter.hit("auth", ["ip:9.9.9.9"])
+        with pytest.raises(RateLimitExceededError):
+            await limiter.hit("auth", ["ip:9.9.9.9"])
+        limiter._blocked.clear()
+        await asyncio.sleep(0.06)
+
+        await limiter.hit("auth", ["ip:9.9.9.9"])
+
+    async def test_unavailable_redis_fails_open(self, redis: FakeRedis) -> None:
+        limiter = RateLimiter(redis, {"auth": RateLimit(capacity=1, period=60)})
+        limiter._script = AsyncMock(side_effect=RedisConnectionError())
+
+        await limiter.hit("auth", ["ip:1.1.1.1"])
+        await limiter.hit("auth", ["ip:1.1.1.1"])
+
+
+class TestIdempotencyStore:
+    @pytest.fixture
+    async def store(self) -> IdempotencyStore:
+        redis = FakeRedis()
+        await redis.flushall()
+        return IdempotencyStore(redis, ttl=60, lock_timeout=0.5, poll_interval=0.01)
+
+    async def test_concurrent_duplicates_execute_once(self, store: IdempotencyStore) -> None:
+        calls = 0
+
+        async def execute() -> bytes:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return b'{"ok":true}'
+
+        first, second = await asyncio.gather(
+            store.run("user", "key-1", "add", execute), store.run("user", "key-1", "add", execute)
+        )
+
+        assert calls == 1
+        assert first.body == second.body == b'{"ok":true}'
+        assert REPLAYED_HEADER.lower() not in first.headers
+        assert second.headers[REPLAYED_HEADER] == "true"
+
+    async def test_client_errors_are_replayed(self, store: IdempotencyStore) -> None:
+        execute = AsyncMock(side_effect=InsufficientFundsError("EUR"))
+
+        with pytest.raises(InsufficientFundsError):
+            await store.run("user", "key-2", "subtract", execute)
+        replay = await store.run("user", "key-2", "subtract", execute)
+
+        execute.assert_awaited_once()
+        assert replay.status_code == InsufficientFundsError("EUR").status_code
+        assert b"INSUFFICIENT_FUNDS" in replay.body
+
+    async def test_other_errors_release_the_key(self, store: IdempotencyStore) -> None:
+        execute = AsyncMock(side_effect=[RuntimeError(), b"{}"])
+
+        with pytest.raises(RuntimeError):
+            await store.run("user", "key-3", "add", execute)
+        response = await store.run("user", "key-3", "add", execute)
+
+        assert response.body == b"{}"
+        assert REPLAYED_HEADER.lower() not in response.headers
+
+    async def test_marker_outlives_slow_request(self, store: IdempotencyStore) -> None:
+        store.lock_timeout = 0.2
+        calls = 0
+
+        async def execute() -> bytes:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.8)
+            return b"{}"
+
+        first = asyncio.create_task(store.run("user", "slow", "add", execute))
+        await asyncio.sleep(0.3)
+        # a retry on another worker, after the marker's original expiry, must not run again
+        other_worker = IdempotencyStore(store.redis, ttl=60, lock_timeout=0.2, poll_interval=0.01)
+        with pytest.raises(IdempotencyInProgressError):
+            await other_worker.run("user", "slow", "add", execute)
+
+        assert (await first).body == b"{}"
+        assert calls == 1
+        replay = await store.run("user", "slow", "add", execute)
+        assert replay.headers[REPLAYED_HEADER] == "true"
+
+    async def test_result_is_not_stored_over_another_owner(self, store: IdempotencyStore) -> None:
+        async def execute() -> bytes:
+            # the marker was lost and another request now holds the key
+            await store.redis.set("idempotency:user:taken", b"other")
+            return b"{}"
+
+        response = await store.run("user", "taken", "add", execute)
+
+        assert response.body == b"{}"
+        assert await store.redis.get("idempotency:user:taken") == b"other"
+        assert "idempotency:user:taken" not in store._inflight
+
+    async def test_duplicate_gives_up_after_lock_timeout(self, store: IdempotencyStore) -> None:
+        # a pending marker left by a request still running on another worker
+        await store.redis.set(
+            "idempotency:user:key-4",
+            orjson.dumps({"fingerprint": _fingerprint("add"), "status": None}),
+            px=60000,
+        )
+        store.lock_timeout = 0.05
+        execute = AsyncMock()
+
+        with pytest.raises(IdempotencyInProgressError):
+            await store.run("user", "key-4", "add", execute)
+        execute.assert_not_awaited()
+
+
+class TestWalletEvents:
+    @pytest.fixture
+    async def redis(self) -> FakeRedis:
+        redis = FakeRedis()
+        await redis.flushall()
+        return redis
+
+    async def test_mutation_on_another_worker_reaches_stream(self, redis: FakeRedis) -> None:
+        publisher = WalletEventHub(redis, keepalive=60, reconnect_delay=0.01)
+        subscriber = WalletEventHub(redis, keepalive=60, reconnect_delay=0.01)
+        subscriber.start()
+        versions = iter([("v1", b"{}"), ("v2", b"{}")])
+        stream = subscriber.stream("user", AsyncMock(side_effect=lambda _: next(versions)))
+
+        assert await anext(stream) == b"event: valuation\nid: v1\ndata: {}\n\n"
+        assert subscriber.stats() == {"users": 1, "streams": 1}
+        next_event = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0.05)
+        await publisher.publish("user")
+
+        assert (await asyncio.wait_for(next_event, 1)).startswith(b"event: valuation\nid: v2")
+        await stream.aclose()
+        assert subscriber.stats() == {"users": 0, "streams": 0}
+        await subscriber.close()
+
+    async def test_unchanged_valuation_sends_only_keepalive(self, redis: FakeRedis) -> None:
+        hub = WalletEventHub(redis, keepalive=0.01, reconnect_delay=0.01)
+        load = AsyncMock(return_value=("v1", b"{}"))
+        stream = hub.stream("user", load)
+
+        await anext(stream)
+        hub.notify_all()
+        assert await anext(stream) == b": keepalive\n\n"
+        assert load.await_args_list == [call(True), call(True)]
+        await stream.aclose()
+
+    async def test_new_rates_table_wakes_streams_spread_without_reload(
+        self, redis: FakeRedis
+    ) -> None:
+        hub = WalletEventHub(redis, keepalive=60, reconnect_delay=0.01, notify_spread=0.05)
+        versions = iter([("v1", b"{}"), ("v2", b"{}")])
+        load = AsyncMock(side_effect=lambda _: next(versions))
+        stream = hub.stream("user", load)
+
+        await anext(stream)
+        hub.notify_all(reload=False)
+        assert not next(iter(hub._subscriptions["user"])).changed.is_set()
+
+        assert (await asyncio.wait_for(anext(stream), 1)).startswith(b"event: valuation\nid: v2")
+        assert load.await_args_list == [call(True), call(False)]
+        await stream.aclose()
+
+    async def test_new_rates_table_notifies_listeners(
+        self, exchange_service: ExchangeRateService
+    ) -> None:
+        listener = Mock()
+        exchange_service.add_table_listener(listener)
+        now = get_current_time()
+
+        exchange_service._set_snapshot(RatesSnapshot({"EUR": Decimal("4.50")}, "2024-01-02", now))
+        exchange_service._set_snapshot(RatesSnapshot({"EUR": Decimal("4.50")}, "2024-01-02", now))
+        listener.assert_not_called()
+        exchange_service._set_snapshot(RatesSnapshot({"EUR": Decimal("4.60")}, "2024-01-03", now))
+        listener.assert_called_once()
+
+
+class TestInvalidationBus:
+    @pytest.fixture
+    async def redis(self) -> FakeRedis:
+        redis = FakeRedis()
+        await redis.flushall()
+        return redis
+
+    def _register(self, bus: InvalidationBus) -> Mock:
+        cache = Mock()
+        bus.register("tokens", cache.evict, cache.clear)
+        return cache
+
+    async def test_other_workers_evict_published_keys(self, redis: FakeRedis) -> None:
+        publisher, subscriber = InvalidationBus(redis, 0.01), InvalidationBus(redis, 0.01)
+        published, evicted = self._register(publisher), self._register(subscriber)
+        publisher.start()
+        subscriber.start()
+        await asyncio.sleep(0.05)
+
+        await publisher.publish("tokens", ["a", "b"])
+        await asyncio.sleep(0.05)
+
+        evicted.evict.assert_called_once_with(["a", "b"])
+        published.evict.assert_not_called()
+        assert subscriber.stats() == {"received": 1, "cleared": 0}
+        await publisher.close()
+        await subscriber.close()
+
+    async def test_missed_message_clears_namespace(self, redis: FakeRedis) -> None:
+        bus = InvalidationBus(redis, 0.01)
+        cache = self._register(bus)
+
+        bus.handle(b'1 {"namespace":"tokens","origin":"other","keys":["a"]}')
+        bus.handle(b'3 {"namespace":"tokens","origin":"other","keys":["c"]}')
+
+        cache.evict.assert_called_once_with(["a"])
+        cache.clear.assert_called_once()
+
+    async def test_reconnect_clears_namespace_that_moved(self, redis: FakeRedis) -> None:
+        bus = InvalidationBus(redis, 0.01)
+        cache = self._register(bus)
+        await bus._sync_versions()
+
+        # published while this worker was disconnected
+        await InvalidationBus(redis, 0.01).publish("tokens", ["a"])
+        await bus._sync_versions()
+
+        cache.clear.assert_called_once()
+
+    async def test_new_table_fetched_elsewhere_is_reloaded(
+        self, redis: FakeRedis, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        bus = InvalidationBus(redis, 0.01)
+        service = ExchangeRateService(invalidation=bus)
+        monkeypatch.setattr(service, "_load_snapshot", AsyncMock())
+
+        bus.handle(b'1 {"namespace":"exchange_rates","origin":"other","keys":["2024-01-03"]}')
+
+        assert service._inflight is not None
+        await service._inflight
+        service._load_snapshot.assert_awaited_once()
+        await service.close()